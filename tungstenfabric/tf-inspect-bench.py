@@ -0,0 +1,769 @@
+#! /usr/bin/env python2
+# encoding=utf8
+
+# Benchmark for tf-inspect.py.
+# Synthetic introspect output shaped like the agent and control node one
+# (ItfSandeshData, RouteUcSandeshData with PathSandeshData/NhSandeshData,
+# ShowRouteTable with ShowRoutePath, next_batch and Pagination/PageReqData
+# links, and a NodeStatus UVE holding every record in one element) is
+# served by a local stand-in server, and Introspect.get plus the printers
+# are timed end to end at several sizes, so that changes in the hot paths
+# can be measured without a lab.
+#
+#   tf-inspect-bench.py                      # all cases, 1k/100k/1M records
+#   tf-inspect-bench.py -n 1000 100000 -c intf-table --mode default stream
+#   tf-inspect-bench.py --json after.json    # keep results to compare
+#   tf-inspect-bench.py --serve --port 8085 -n 5000  # server for ist
+#   tf-inspect-bench.py --check -n 1000      # ist output sanity checks
+
+import sys
+reload(sys)
+sys.setdefaultencoding('utf8')
+
+import os
+import imp
+import re
+import csv
+import tempfile
+import shutil
+import subprocess
+import time
+import json
+import socket
+import resource
+import argparse
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+Default_Records = [1000, 100000, 1000000]
+Default_Page_Size = 100
+Chunk_Records = 1000
+Modes = {
+    'default': {},
+    'stream': {'stream': True},
+    'pipeline': {'pipeline': True},
+    'stream-pipeline': {'stream': True, 'pipeline': True},
+}
+
+def ip(i):
+    return '10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255)
+
+def mac(i):
+    return '02:00:%02x:%02x:%02x:%02x' % (i >> 24 & 255, i >> 16 & 255,
+                                          i >> 8 & 255, i & 255)
+
+def stamp(i):
+    return '2026-Oct-18 %02d:%02d:%02d.%06d' % (i / 3600 % 24, i / 60 % 60,
+                                                i % 60, i * 7919 % 1000000)
+
+def itfRecord(i):
+    """ one vrouter interface, ItfReq """
+    return (
+        '<ItfSandeshData>'
+        '<index type="i32" identifier="1">%d</index>'
+        '<name type="string" identifier="2">tap%08x-%02x</name>'
+        '<uuid type="string" identifier="3">%08x-0000-4000-8000-%012x</uuid>'
+        '<vrf_name type="string" identifier="4">default-domain:p%d:vn%d:vn%d'
+        '</vrf_name>'
+        '<active type="string" identifier="5">%s</active>'
+        '<dhcp_service type="string" identifier="6">Enable</dhcp_service>'
+        '<dns_service type="string" identifier="7">Enable</dns_service>'
+        '<type type="string" identifier="8">vport</type>'
+        '<label type="i32" identifier="9">%d</label>'
+        '<vn_name type="string" identifier="10">default-domain:p%d:vn%d'
+        '</vn_name>'
+        '<vm_uuid type="string" identifier="11">%08x-1111-4000-8000-%012x'
+        '</vm_uuid>'
+        '<vm_name type="string" identifier="12">vm-%d</vm_name>'
+        '<ip_addr type="string" identifier="13">%s</ip_addr>'
+        '<mac_addr type="string" identifier="14">%s</mac_addr>'
+        '<policy type="string" identifier="15">Enable</policy>'
+        '<fip_list type="list" identifier="16"><list type="struct" size="1">'
+        '<FloatingIpSandeshList>'
+        '<ip_addr type="string" identifier="1">172.16.%d.%d</ip_addr>'
+        '<vrf_name type="string" identifier="2">public</vrf_name>'
+        '<installed type="string" identifier="3">Y</installed>'
+        '</FloatingIpSandeshList></list></fip_list>'
+        '<mdata_ip_addr type="string" identifier="17">169.254.%d.%d'
+        '</mdata_ip_addr>'
+        '<sg_uuid_list type="list" identifier="18">'
+        '<list type="struct" size="1"><VmIntfSgUuid>'
+        '<sg_uuid type="string" identifier="1">%08x-2222-4000-8000-000000000001'
+        '</sg_uuid></VmIntfSgUuid></list></sg_uuid_list>'
+        '<l2_label type="i32" identifier="19">%d</l2_label>'
+        '<vxlan_id type="i32" identifier="20">%d</vxlan_id>'
+        '<ipv4_active type="string" identifier="21">Active</ipv4_active>'
+        '<l2_active type="string" identifier="22">L2 Active</l2_active>'
+        '<ip6_active type="string" identifier="23">Ipv6 Inactive'
+        '</ip6_active>'
+        '<admin_state type="string" identifier="24">Enabled</admin_state>'
+        '<os_ifindex type="i32" identifier="25">%d</os_ifindex>'
+        '<flow_key_idx type="i32" identifier="26">%d</flow_key_idx>'
+        '<static_route_list type="list" identifier="27">'
+        '<list type="string" size="0"></list></static_route_list>'
+        '</ItfSandeshData>' %
+        (i, i, i & 255, i, i, i % 10, i % 100, i % 100,
+         'Inactive' if i % 97 == 0 else 'Active', 16 + i, i % 10, i % 100,
+         i, i, i, ip(i), mac(i), i >> 8 & 255, i & 255, i >> 8 & 255, i & 255,
+         i % 10, 16 + i, i % 100, 100 + i, i))
+
+def nhRecord(i):
+    """ local routes go to an interface, the others to a tunnel """
+    if i % 10 == 0:
+        return ('<NhSandeshData>'
+                '<type type="string" identifier="1">interface</type>'
+                '<ref_count type="i32" identifier="2">4</ref_count>'
+                '<valid type="string" identifier="3">true</valid>'
+                '<policy type="string" identifier="4">enabled</policy>'
+                '<itf type="string" identifier="5">tap%08x-%02x</itf>'
+                '<mac type="string" identifier="6">%s</mac>'
+                '<nh_index type="i32" identifier="7">%d</nh_index>'
+                '<vrf type="string" identifier="8">default-domain:p0:vn0:vn0'
+                '</vrf>'
+                '</NhSandeshData>' % (i, i & 255, mac(i), i % 65536))
+    return ('<NhSandeshData>'
+            '<type type="string" identifier="1">tunnel</type>'
+            '<ref_count type="i32" identifier="2">%d</ref_count>'
+            '<valid type="string" identifier="3">true</valid>'
+            '<policy type="string" identifier="4">disabled</policy>'
+            '<sip type="string" identifier="5">192.168.0.1</sip>'
+            '<dip type="string" identifier="6">192.168.%d.%d</dip>'
+            '<tunnel_type type="string" identifier="7">MPLSoUDP</tunnel_type>'
+            '<nh_index type="i32" identifier="8">%d</nh_index>'
+            '<vrf type="string" identifier="9">default-domain:default-project:'
+            'ip-fabric:__default__</vrf>'
+            '</NhSandeshData>' % (i % 50, i >> 8 & 255, i % 250 + 2,
+                                  i % 65536))
+
+def routeRecord(i):
+    """ one vrouter unicast route, Inet4UcRouteReq """
+    return (
+        '<RouteUcSandeshData>'
+        '<src_ip type="string" identifier="1">%s</src_ip>'
+        '<src_plen type="i32" identifier="2">32</src_plen>'
+        '<src_vrf type="string" identifier="3">default-domain:p0:vn0:vn0'
+        '</src_vrf>'
+        '<path_list type="list" identifier="4">'
+        '<list type="struct" size="1"><PathSandeshData>'
+        '<nh type="struct" identifier="1">%s</nh>'
+        '<label type="i32" identifier="2">%d</label>'
+        '<vxlan_id type="i32" identifier="3">0</vxlan_id>'
+        '<peer type="string" identifier="4">%s</peer>'
+        '<dest_vn_list type="list" identifier="5"><list type="string" '
+        'size="1"><element>default-domain:p0:vn%d</element></list>'
+        '</dest_vn_list>'
+        '<unresolved type="string" identifier="6">false</unresolved>'
+        '<sg_list type="list" identifier="7"><list type="i32" size="1">'
+        '<element>8000001</element></list></sg_list>'
+        '<supported_tunnel_type type="string" identifier="8">MPLSoGRE '
+        'MPLSoUDP VxLAN </supported_tunnel_type>'
+        '<active_tunnel_type type="string" identifier="9">MPLSoUDP'
+        '</active_tunnel_type>'
+        '<stale type="bool" identifier="10">false</stale>'
+        '<path_preference_data type="struct" identifier="11">'
+        '<PathPreferenceSandeshData>'
+        '<sequence type="i32" identifier="1">0</sequence>'
+        '<preference type="string" identifier="2">%s</preference>'
+        '<ecmp type="bool" identifier="3">false</ecmp>'
+        '<wait_for_traffic type="bool" identifier="4">false'
+        '</wait_for_traffic>'
+        '</PathPreferenceSandeshData></path_preference_data>'
+        '<active_label type="i32" identifier="12">%d</active_label>'
+        '<communities type="list" identifier="13"><list type="string" '
+        'size="0"></list></communities>'
+        '</PathSandeshData></list></path_list>'
+        '</RouteUcSandeshData>' %
+        (ip(i), nhRecord(i), 16 + i,
+         'LocalVmPort' if i % 10 == 0 else '10.1.1.%d' % (i % 3 + 1),
+         i % 100, 'high' if i % 10 == 0 else 'low', 16 + i))
+
+def ctrRouteRecord(i):
+    """ one control node route with an XMPP and a BGP path, ShowRouteReq """
+    paths = ''
+    for protocol, source in (('XMPP', 'compute%d' % (i % 500)),
+                             ('BGP', '10.1.1.%d' % (i % 3 + 1))):
+        paths += (
+            '<ShowRoutePath>'
+            '<protocol type="string" identifier="1">%s</protocol>'
+            '<last_modified type="string" identifier="2">%s</last_modified>'
+            '<local_preference type="i32" identifier="3">%d'
+            '</local_preference>'
+            '<med type="i32" identifier="4">0</med>'
+            '<peer_router_id type="string" identifier="5">10.1.1.%d'
+            '</peer_router_id>'
+            '<as_path type="string" identifier="6">%s</as_path>'
+            '<next_hop type="string" identifier="7">192.168.%d.%d</next_hop>'
+            '<label type="i32" identifier="8">%d</label>'
+            '<replicated type="bool" identifier="9">false</replicated>'
+            '<primary_table type="string" identifier="10"></primary_table>'
+            '<secondary_tables type="list" identifier="11">'
+            '<list type="string" size="0"></list></secondary_tables>'
+            '<communities type="list" identifier="12"><list type="string" '
+            'size="1"><element>64512:8000001</element></list></communities>'
+            '<origin_vn type="string" identifier="13">default-domain:p0:vn%d'
+            '</origin_vn>'
+            '<flags type="string" identifier="14"></flags>'
+            '<tunnel_encap type="list" identifier="15"><list type="string" '
+            'size="2"><element>gre</element><element>udp</element></list>'
+            '</tunnel_encap>'
+            '<sequence_no type="string" identifier="16">%d</sequence_no>'
+            '<source type="string" identifier="17">%s</source>'
+            '<origin_vn_path type="list" identifier="18"><list type="string" '
+            'size="1"><element>default-domain:p0:vn%d</element></list>'
+            '</origin_vn_path>'
+            '</ShowRoutePath>' %
+            (protocol, stamp(i), 100 if protocol == 'XMPP' else 90,
+             i % 3 + 1, '' if protocol == 'XMPP' else '64512',
+             i >> 8 & 255, i % 250 + 2, 16 + i, i % 100, i, source,
+             i % 100))
+    return ('<ShowRoute>'
+            '<prefix type="string" identifier="1">%s/32</prefix>'
+            '<last_modified type="string" identifier="2">%s</last_modified>'
+            '<paths type="list" identifier="3"><list type="struct" size="2">'
+            '%s</list></paths>'
+            '</ShowRoute>' % (ip(i), stamp(i), paths))
+
+def processRecord(i):
+    """ one ProcessStatus of a NodeStatus UVE, with its connections """
+    return ('<ProcessStatus>'
+            '<module_id type="string" identifier="1">contrail-module-%d'
+            '</module_id>'
+            '<instance_id type="string" identifier="2">%d</instance_id>'
+            '<state type="string" identifier="3">%s</state>'
+            '<connection_infos type="list" identifier="4">'
+            '<list type="struct" size="2"><ConnectionInfo>'
+            '<type type="string" identifier="1">Collector</type>'
+            '<name type="string" identifier="2"></name>'
+            '<server_addrs type="list" identifier="3"><list type="string" '
+            'size="1"><element>%s:8086</element></list></server_addrs>'
+            '<status type="string" identifier="4">Up</status>'
+            '<description type="string" identifier="5">Established'
+            '</description>'
+            '</ConnectionInfo><ConnectionInfo>'
+            '<type type="string" identifier="1">Database</type>'
+            '<name type="string" identifier="2">Cassandra</name>'
+            '<server_addrs type="list" identifier="3"><list type="string" '
+            'size="1"><element>%s:9042</element></list></server_addrs>'
+            '<status type="string" identifier="4">%s</status>'
+            '<description type="string" identifier="5"></description>'
+            '</ConnectionInfo></list></connection_infos>'
+            '<description type="string" identifier="5"></description>'
+            '</ProcessStatus>' %
+            (i, i % 4, 'Non-Functional' if i % 97 == 0 else 'Functional',
+             ip(i), ip(i + 1), 'Down' if i % 97 == 0 else 'Up'))
+
+class Generator(object):
+    """ paged introspect responses over `records` synthetic records.
+        respond() returns the body of a request path as a list of chunks,
+        which are generated lazily so a 1M records output is never held """
+
+    def __init__(self, records, page_size=Default_Page_Size):
+        self.records = records
+        self.page_size = page_size
+
+    def respond(self, path):
+        url = urlparse.urlparse(path)
+        name = url.path.lstrip('/')
+        query = dict(urlparse.parse_qsl(url.query, keep_blank_values=True))
+        x = query.get('x', '')
+        if name in ('Snh_ItfReq', 'Snh_ItfReqIterate'):
+            return self.batch('ItfResp', 'itf_list', itfRecord,
+                              'ItfReqIterate', int(x or 0))
+        if name in ('Snh_Inet4UcRouteReq', 'Snh_Inet4UcRouteReqIterate'):
+            return self.batch('Inet4UcRouteResp', 'route_list', routeRecord,
+                              'Inet4UcRouteReqIterate', int(x or 0))
+        if name == 'Snh_ShowRouteReq':
+            return self.pagination(0, self.page_size)
+        if name == 'Snh_PageReq':
+            if x == 'all':
+                return self.pagination(0, self.records, paginate=False)
+            return self.pagination(int(x or 0), self.page_size)
+        if name == 'Snh_SandeshUVECacheReq':
+            return self.uve()
+        return None
+
+    def records_xml(self, record, start, end):
+        for first in xrange(start, end, Chunk_Records):
+            yield ''.join(record(i) for i in
+                          xrange(first, min(end, first + Chunk_Records)))
+
+    def batch(self, resp, field, record, link, start):
+        """ agent style: one page per request, next_batch to the rest """
+        end = min(self.records, start + self.page_size)
+        yield ('<?xml-stylesheet type="text/xsl" href="/universal_parse.xsl"?>'
+               '<__%s_list type="slist"><%s type="sandesh">'
+               '<%s type="list" identifier="1">'
+               '<list type="struct" size="%d">' %
+               (resp, resp, field, end - start))
+        for chunk in self.records_xml(record, start, end):
+            yield chunk
+        yield ('</list></%s><more type="bool" identifier="0">%s</more>'
+               '</%s>' % (field, 'true' if end < self.records else 'false',
+                          resp))
+        if end < self.records:
+            yield ('<next_batch type="string" link="%s" text="next_batch">'
+                   '%d</next_batch>' % (link, end))
+        yield '</__%s_list>' % resp
+
+    def uve(self):
+        """ UVE cache style: a single page, and a single element holding
+            all records, as text printers get it """
+        yield ('<?xml-stylesheet type="text/xsl" href="/universal_parse.xsl"?>'
+               '<__NodeStatusUVE_list type="slist">'
+               '<NodeStatusUVE type="sandesh">'
+               '<data type="struct" identifier="1"><NodeStatus>'
+               '<name type="string" identifier="1" key="ObjectVRouter">'
+               'compute0</name>'
+               '<process_status type="list" identifier="2">'
+               '<list type="struct" size="%d">' % self.records)
+        for chunk in self.records_xml(processRecord, 0, self.records):
+            yield chunk
+        yield ('</list></process_status></NodeStatus></data>'
+               '</NodeStatusUVE></__NodeStatusUVE_list>')
+
+    def pagination(self, start, count, paginate=True):
+        """ control node style: pages with Pagination/PageReqData """
+        end = min(self.records, start + count)
+        yield ('<?xml-stylesheet type="text/xsl" href="/universal_parse.xsl"?>'
+               '<__ShowRouteResp_list type="slist">'
+               '<ShowRouteResp type="sandesh">'
+               '<tables type="list" identifier="1">'
+               '<list type="struct" size="1"><ShowRouteTable>'
+               '<routing_instance type="string" identifier="1">'
+               'default-domain:default-project:ip-fabric:__default__'
+               '</routing_instance>'
+               '<routing_table_name type="string" identifier="2">inet.0'
+               '</routing_table_name>'
+               '<deleted type="bool" identifier="3">false</deleted>'
+               '<deleted_at type="string" identifier="4"></deleted_at>'
+               '<prefixes type="u64" identifier="5">%d</prefixes>'
+               '<primary_paths type="u64" identifier="6">%d</primary_paths>'
+               '<secondary_paths type="u64" identifier="7">%d'
+               '</secondary_paths>'
+               '<infeasible_paths type="u64" identifier="8">0'
+               '</infeasible_paths>'
+               '<stale_paths type="u64" identifier="9">0</stale_paths>'
+               '<paths type="u64" identifier="10">%d</paths>'
+               '<routes type="list" identifier="11">'
+               '<list type="struct" size="%d">' %
+               (self.records, self.records, self.records, 2 * self.records,
+                end - start))
+        for chunk in self.records_xml(ctrRouteRecord, start, end):
+            yield chunk
+        yield ('</list></routes></ShowRouteTable></list></tables>'
+               '</ShowRouteResp>')
+        if paginate:
+            yield ('<Pagination type="sandesh"><req type="struct" '
+                   'identifier="1"><PageReqData>'
+                   '<prev_page type="string" identifier="1">%s</prev_page>'
+                   '<next_page type="string" identifier="2">%s</next_page>'
+                   '<first_page type="string" identifier="3">0</first_page>'
+                   '<all type="string" identifier="4">all</all>'
+                   '</PageReqData></req></Pagination>' %
+                   (max(0, start - self.page_size) if start else '',
+                    end if end < self.records else ''))
+        yield '</__ShowRouteResp_list>'
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ keep-alive HTTP/1.1 server, bodies are sent chunked as generated """
+
+    protocol_version = 'HTTP/1.1'
+    # chunks are written to a buffer sent in full segments, small writes
+    # would wait for delayed ACKs on a keep-alive connection
+    wbufsize = 1 << 16
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        body = self.server.generator.respond(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for chunk in body:
+            self.wfile.write('%x\r\n%s\r\n' % (len(chunk), chunk))
+        self.wfile.write('0\r\n\r\n')
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+    allow_reuse_address = True
+
+    def __init__(self, port, generator):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                                           StandInHandler)
+        self.generator = generator
+
+    def handle_error(self, request, client_address):
+        # clients stopping early (ist --limit, a closed pipe) drop the
+        # connection mid body, which isn't worth a traceback
+        if not isinstance(sys.exc_info()[1], socket.error):
+            SocketServer.TCPServer.handle_error(self, request,
+                                                client_address)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+def loadInspect(script):
+    """ tf-inspect.py isn't importable by name, load it as a module """
+    mod = imp.load_source('tf_inspect', script)
+    # lazily imported modules are loaded up front, out of the timings.
+    # Older copies given to --script import them at load time already
+    mod.etree.fromstring('<warmup/>')
+    if hasattr(mod, 'prettytable'):
+        mod.prettytable.PrettyTable(['warmup'])
+        mod.urllib2.URLError
+        mod.saxutils.unescape('')
+    return mod
+
+Itf_Path = 'Snh_ItfReq?name=&type=&uuid=&vn=&mac=&ipv4_address='
+Route_Path = 'Snh_Inet4UcRouteReq?vrf_index=0&src_ip=&prefix_len=32&stale='
+Ctr_Path = ('Snh_ShowRouteReq?routing_table=&routing_instance=&prefix='
+            '&longer_match=&shorter_match=&count=&start_routing_table='
+            '&start_routing_instance=&start_prefix=&source=&protocol='
+            '&family=')
+Uve_Path = 'Snh_SandeshUVECacheReq?x=NodeStatus'
+Itf_Columns = ['index', 'name', 'active', 'mac_addr', 'ip_addr',
+               'mdata_ip_addr', 'vm_name', 'vn_name']
+
+# name: (request path, printer), printers run what `ist` would run
+Cases = [
+    ('intf-table', (Itf_Path, lambda mod, ist, n: ist.printTbl(
+        '//ItfSandeshData', mod.Default_Max_Width, *Itf_Columns))),
+    ('intf-text', (Itf_Path, lambda mod, ist, n: ist.printText(
+        '//ItfSandeshData'))),
+    # one element of every record, text is written as it's formatted
+    ('uve-text', (Uve_Path, lambda mod, ist, n: ist.printText(
+        '//*[@type="sandesh"]/data/*'))),
+    ('intf-jsonl', (Itf_Path, lambda mod, ist, n: ist.printRecords(
+        '//ItfSandeshData', 'jsonl', *Itf_Columns))),
+    ('vr-route', (Route_Path, lambda mod, ist, n: ist.showRoute_VR(
+        '//RouteUcSandeshData', 'inet', '', 'brief'))),
+    ('vr-route-lookup', (Route_Path, lambda mod, ist, n: ist.showRoute_VR(
+        '//RouteUcSandeshData', 'inet', ip(n / 2), 'brief'))),
+    ('ctr-route', (Ctr_Path, lambda mod, ist, n: ist.showRoute_CTR(
+        None, 'brief'))),
+    ('ctr-route-detail', (Ctr_Path, lambda mod, ist, n: ist.showRoute_CTR(
+        None, 'detail'))),
+]
+
+def peakRSS():
+    """ as Timings.peakRSS, which older copies of tf-inspect.py lack """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss << 10
+
+class NullOutput(object):
+    """ /dev/null as stdout, remembering when output started """
+
+    encoding = None
+    softspace = 0
+
+    def __init__(self):
+        self.null = open(os.devnull, 'w')
+        self.first = None
+
+    def write(self, data):
+        if self.first is None and data:
+            self.first = time.time()
+        self.null.write(data)
+
+    def flush(self):
+        self.null.flush()
+
+def runCase(mod, port, case, mode, records, timings):
+    """ run one case in a child process, so that peak RSS and leftovers
+        are its own. Returns the result dict """
+    path, printer = dict(Cases)[case]
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        result = {}
+        try:
+            for name, value in Modes[mode].iteritems():
+                setattr(mod, name, value)
+            if timings:
+                mod.timings = mod.Timings()
+            sys.stdout = NullOutput()
+            ist = mod.Introspect('127.0.0.1', port, None)
+            start = time.time()
+            ist.get(path)
+            got = time.time()
+            printer(mod, ist, records)
+            sys.stdout.flush()
+            end = time.time()
+            result = {'get': got - start, 'print': end - got,
+                      'total': end - start,
+                      'first': (sys.stdout.first or end) - start,
+                      'rss': peakRSS()}
+            if timings:
+                pages = mod.timings.pages
+                result.update({
+                    'pages': len(pages),
+                    'bytes': sum(page['bytes'] for page in pages),
+                    'fetch': sum(page['latency'] for page in pages),
+                    'parse': sum(page['parse'] for page in pages),
+                    'render': sum(mod.timings.render.values())})
+        except BaseException as e:
+            result = {'error': '%s: %s' % (type(e).__name__, e)}
+        os.write(wfd, json.dumps(result))
+        os._exit(0)
+    os.close(wfd)
+    data = []
+    while True:
+        chunk = os.read(rfd, 65536)
+        if not chunk:
+            break
+        data.append(chunk)
+    os.close(rfd)
+    _, status = os.waitpid(pid, 0)
+    if data:
+        result = json.loads(''.join(data))
+    elif os.WIFSIGNALED(status):
+        # typically SIGKILL from the OOM killer
+        result = {'error': 'killed by signal %d' % os.WTERMSIG(status)}
+    else:
+        result = {'error': 'exited with status %d' %
+                           os.WEXITSTATUS(status)}
+    result.update({'case': case, 'mode': mode, 'records': records})
+    return result
+
+def printResult(result, timings):
+    if 'error' in result:
+        print "%-17s %-15s %8d  ERROR %s" % (result['case'], result['mode'],
+                                            result['records'],
+                                            result['error'])
+    else:
+        line = ("%-17s %-15s %8d %9.3f %9.3f %9.3f %9.3f %10d %8.1f" %
+                (result['case'], result['mode'], result['records'],
+                 result['get'], result['print'], result['total'],
+                 result['first'],
+                 result['records'] / max(result['total'], 1e-6),
+                 result['rss'] / 1048576.0))
+        if timings:
+            line += " %9.3f %9.3f %9.3f" % (result['fetch'], result['parse'],
+                                            result['render'])
+        print line
+    sys.stdout.flush()
+
+def jsonlRecords(out):
+    """ every line is a json object """
+    return [json.loads(line) for line in out.splitlines()]
+
+def csvRecords(delimiter):
+    def parse(out):
+        """ a header line, then rows of as many cells """
+        rows = list(csv.reader(out.splitlines(), delimiter=delimiter))
+        for row in rows[1:]:
+            if len(row) != len(rows[0]):
+                raise ValueError("%d cells under %d fields: %r" %
+                                 (len(row), len(rows[0]), row))
+        return rows[1:]
+    return parse
+
+def runIst(script, argv):
+    """ `ist` as a user runs it, returns (status, stdout, stderr) """
+    proc = subprocess.Popen([sys.executable, script] + argv,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    return proc.returncode, out, err
+
+# name: (ist arguments, parser of stdout, expected records or None)
+# HOST, HOSTS, PORT and ARCHIVE are filled in by runChecks
+Checks = [
+    ('intf-jsonl', ['--host', 'HOST', '--port', 'PORT', 'vr', 'intf',
+                    '-f', 'jsonl'], jsonlRecords, 1),
+    ('intf-jsonl-stream', ['--host', 'HOST', '--port', 'PORT', '--stream',
+                           'vr', 'intf', '-f', 'jsonl'], jsonlRecords, 1),
+    ('intf-jsonl-limit', ['--host', 'HOST', '--port', 'PORT', '--limit',
+                          '5', 'vr', 'intf', '-f', 'jsonl'],
+     jsonlRecords, None),
+    ('intf-jsonl-hosts', ['--host', 'HOSTS', '--port', 'PORT', 'vr', 'intf',
+                          '-f', 'jsonl'], jsonlRecords, 2),
+    ('intf-csv', ['--host', 'HOST', '--port', 'PORT', 'vr', 'intf',
+                  '-f', 'csv'], csvRecords(','), 1),
+    ('intf-tsv-hosts', ['--host', 'HOSTS', '--port', 'PORT', 'vr', 'intf',
+                        '-f', 'tsv'], csvRecords('\t'), 2),
+    ('health-jsonl', ['--host', 'HOST', 'health', '-f', 'jsonl',
+                      '--timeout', '1'], jsonlRecords, None),
+    ('intf-jsonl-capture', ['--host', 'HOST', '--port', 'PORT', '--capture',
+                            'ARCHIVE', 'vr', 'intf', '-f', 'jsonl'],
+     jsonlRecords, 1),
+    ('intf-jsonl-replay', ['--file', 'ARCHIVE', 'vr', 'intf', '-f', 'jsonl'],
+     jsonlRecords, 1),
+]
+
+# --capture in one mode, --file replay in another, output compared with
+# the live one of the replay mode
+Round_Trip_Modes = [
+    ('default', []),
+    ('stream', ['--stream']),
+    ('pipeline', ['--pipeline']),
+    ('limit', ['--limit', '150']),
+]
+Round_Trip_Commands = [
+    ('ctr-route', ['ctr', 'route', 'show']),
+    ('intf', ['vr', 'intf', '-f', 'jsonl']),
+]
+
+def ageless(out):
+    """ ages are counted from now, drop them to compare outputs """
+    return re.sub(r'age: [^,]*,', 'age: X,', out)
+
+def runRoundTrips(script, port, tmpdir):
+    """ replay archives captured in each mode in each mode. A --limit
+        capture only holds the pages it read, so it is replayed with the
+        same limit. Returns the number of failed round trips """
+    failed = 0
+    live = ['--host', '127.0.0.1', '--port', str(port)]
+    for command, argv in Round_Trip_Commands:
+        expected = {}
+        for mode, options in Round_Trip_Modes:
+            expected[mode] = runIst(script, live + options + argv)
+        for captured, options in Round_Trip_Modes:
+            archive = os.path.join(tmpdir, '%s-%s.tar.gz' %
+                                   (command, captured))
+            runIst(script, live + ['--capture', archive] + options + argv)
+            for replayed, replay_options in Round_Trip_Modes:
+                if captured == 'limit' and replayed != 'limit':
+                    continue
+                name = '%s %s>%s' % (command, captured, replayed)
+                status, out, err = runIst(script, ['--file', archive] +
+                                          replay_options + argv)
+                if status:
+                    failed += 1
+                    print "%-28s FAIL exit status %d: %s" % (
+                        name, status, ' '.join((err or out).split()[-12:]))
+                elif ageless(out) != ageless(expected[replayed][1]):
+                    failed += 1
+                    print "%-28s FAIL output differs from the live one" % name
+                else:
+                    print "%-28s ok   %d lines" % (name, out.count('\n'))
+    return failed
+
+def runChecks(script, port, records):
+    """ run `ist` against the stand-in server and parse what it prints.
+        Returns the number of failed checks """
+    tmpdir = tempfile.mkdtemp(prefix='tf-inspect-check-')
+    values = {'HOST': '127.0.0.1', 'HOSTS': '127.0.0.1,localhost',
+              'PORT': str(port),
+              'ARCHIVE': os.path.join(tmpdir, 'capture.tar.gz')}
+    failed = 0
+    try:
+        for name, argv, parse, hosts in Checks:
+            argv = [values.get(arg, arg) for arg in argv]
+            status, out, err = runIst(script, argv)
+            try:
+                if status:
+                    raise ValueError("exit status %d: %s" %
+                                     (status, err.strip()))
+                got = parse(out)
+                if hosts is not None and len(got) != hosts * records:
+                    raise ValueError("%d records, %d expected" %
+                                     (len(got), hosts * records))
+            except ValueError as e:
+                failed += 1
+                print "%-20s FAIL %s" % (name, e)
+            else:
+                print "%-20s ok   %d records" % (name, len(got))
+        failed += runRoundTrips(script, port, tmpdir)
+    finally:
+        shutil.rmtree(tmpdir)
+    return failed
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='tf-inspect-bench',
+        description='Time tf-inspect commands against a local stand-in '
+                    'introspect server serving synthetic output.')
+    parser.add_argument('--script', type=str,
+                        default=os.path.join(os.path.dirname(
+                            os.path.abspath(__file__)), 'tf-inspect.py'),
+                        help="tf-inspect.py to benchmark. Default: the one "
+                             "next to this script")
+    parser.add_argument('-n', '--records', type=int, nargs='+',
+                        default=Default_Records,
+                        help="Number of records. Default: %s" %
+                             ' '.join(str(n) for n in Default_Records))
+    parser.add_argument('-c', '--case', nargs='+',
+                        choices=[name for name, _ in Cases],
+                        default=[name for name, _ in Cases],
+                        help="Cases to run. Default: all")
+    parser.add_argument('--mode', nargs='+', choices=sorted(Modes),
+                        default=['default', 'stream'],
+                        help="tf-inspect modes to run each case in. "
+                             "Default: default stream")
+    parser.add_argument('--page-size', type=int, default=Default_Page_Size,
+                        help="Records per next_batch/Pagination page. "
+                             "Default: %d" % Default_Page_Size)
+    parser.add_argument('--timings', action="store_true",
+                        help="Also split fetch, parse and render times "
+                             "with tf-inspect --timings")
+    parser.add_argument('--json', type=str, metavar='FILE',
+                        help="Write results to FILE as JSON")
+    parser.add_argument('--port', type=int, default=0,
+                        help="Stand-in server port. Default: any free one")
+    parser.add_argument('--serve', action="store_true",
+                        help="Only run the stand-in server, with the first "
+                             "--records count, e.g. for "
+                             "`ist --host 127.0.0.1 --port PORT vr intf`")
+    parser.add_argument('--check', action="store_true",
+                        help="Instead of timing, run ist against the "
+                             "stand-in server with the first --records "
+                             "count, check that jsonl/csv/tsv output "
+                             "parses with nothing else mixed in, and that "
+                             "--capture archives replay in every mode")
+    args = parser.parse_args()
+
+    generator = Generator(args.records[0], args.page_size)
+    server = StandInServer(args.port, generator)
+    port = server.server_address[1]
+
+    if args.serve:
+        print "Serving %d records on 127.0.0.1:%d" % (generator.records, port)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if args.check:
+        server.start()
+        sys.exit(1 if runChecks(args.script, port, generator.records) else 0)
+
+    mod = loadInspect(args.script)
+    server.start()
+
+    header = ("%-17s %-15s %8s %9s %9s %9s %9s %10s %8s" %
+              ('case', 'mode', 'records', 'get(s)', 'print(s)', 'total(s)',
+               'first(s)', 'records/s', 'rss(MB)'))
+    if args.timings:
+        header += " %9s %9s %9s" % ('fetch(s)', 'parse(s)', 'render(s)')
+    print header
+
+    results = []
+    for records in args.records:
+        generator.records = records
+        for case in args.case:
+            for mode in args.mode:
+                result = runCase(mod, port, case, mode, records, args.timings)
+                printResult(result, args.timings)
+                results.append(result)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'script': args.script, 'page_size': args.page_size,
+                       'results': results}, f, indent=1)
+            f.write('\n')
+
+if __name__ == "__main__":
+    main()
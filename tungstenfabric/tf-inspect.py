@@ -16,16 +16,90 @@ reload(sys)
 sys.setdefaultencoding('utf8')
 
 import os
+import re
+import time
+import zlib
+import hashlib
+import importlib
+import textwrap
+import json
+import csv
 import argparse
 import socket, struct
-from urllib2 import urlopen, URLError, HTTPError
-from datetime import datetime
-from lxml import etree
-from prettytable import PrettyTable
-from uuid import UUID
+import threading
+import asyncore
+import select
+import errno
+import heapq
+import resource
+import Queue
+import signal
+from cStringIO import StringIO
+from datetime import datetime, timedelta
+from collections import OrderedDict
+from itertools import islice
+
+class LazyModule(object):
+    """ module imported on first attribute access, so that commands
+        which never need it don't pay for importing it at start-up """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+etree = LazyModule('lxml.etree')
+prettytable = LazyModule('prettytable')
+httplib = LazyModule('httplib')
+urllib2 = LazyModule('urllib2')
+tarfile = LazyModule('tarfile')
+tempfile = LazyModule('tempfile')
+saxutils = LazyModule('xml.sax.saxutils')
+threadpool = LazyModule('multiprocessing.pool')
+uuid = LazyModule('uuid')
+sqlite3 = LazyModule('sqlite3')
 
 debug = False
+stream = False
+pipeline = False
+asynchronous = False
+limit = None
 Default_Max_Width = 36
+Table_Sample = 100
+Pipeline_Depth = 4
+Default_Workers = 32
+Async_Timeout = 60
+Health_Workers = 256
+Health_Timeout = 3
+workers = Default_Workers
+cache = None
+capture = None
+snapshot = None
+timings = None
+failures = 0
+Default_Cache_Dir = os.path.expanduser('~/.cache/ist')
+Default_Cache_TTL = 60
+Default_Cache_Size = 64
+
+# natural identifier of records for --watch, others fall back to the
+# first of Watch_Default_Keys they have
+Watch_Keys = {
+    'ItfSandeshData': 'index',
+    'VrfSandeshData': 'name',
+    'VnSandeshData': 'name',
+    'VmSandeshData': 'uuid',
+    'NhSandeshData': 'nh_index',
+    'MplsSandeshData': 'label',
+    'SgSandeshData': 'sg_uuid',
+    'AclSandeshData': 'uuid',
+    'BgpNeighborResp': 'peer_address',
+    'ShowRoutingInstance': 'name',
+}
+Watch_Default_Keys = ('index', 'name', 'uuid', 'uuid_str')
 
 ServiceMap = {
     "vr": "contrail-vrouter-agent",
@@ -47,46 +121,1165 @@ ServiceMap = {
     "nodemgr_analytics": "contrail-analytics-nodemgr",
 }
 
+class IntrospectError(Exception):
+    """ introspect request failed, str() gives the full report """
+
+    def __init__(self, summary, url, detail):
+        Exception.__init__(self, summary, url, detail)
+        self.summary = summary
+        self.url = url
+        self.detail = detail
+
+    def __str__(self):
+        return '%s\nURL: %s\n%s' % (self.summary, self.url, self.detail)
+
+class HttpConnPool(object):
+    """ per-host pool of HTTP/1.1 keep-alive connections.
+        One pool is shared by all Introspect instances of the process, so
+        next_batch/PageReq hops and later commands reuse the same sockets """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+
+    def _acquire(self, host, port, reuse=True):
+        with self.lock:
+            idle = self.idle.get((host, port))
+            if reuse and idle:
+                return idle.pop(), True
+            self.connections += 1
+        return httplib.HTTPConnection(host, port, timeout=self.timeout), False
+
+    def release(self, host, port, conn):
+        with self.lock:
+            self.idle.setdefault((host, port), []).append(conn)
+
+    def urlopen(self, host, port, path):
+        """ send GET request and return a file-like response.
+            Raises HTTPError/URLError just like urllib2.urlopen """
+        url = "http://%s:%s%s" % (host, port, path)
+        with self.lock:
+            self.requests += 1
+        conn, reused = self._acquire(host, port)
+        while True:
+            try:
+                conn.request('GET', path)
+                response = conn.getresponse()
+                break
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                if not reused:
+                    raise urllib2.URLError(e)
+                # idle connection was closed by peer, retry with a new one
+                if debug: print "DEBUG: stale keep-alive connection to " + url
+                conn, reused = self._acquire(host, port, reuse=False)
+
+        response = PooledResponse(self, host, port, conn, response)
+        if response.status != 200:
+            response.read()
+            response.close()
+            raise urllib2.HTTPError(url, response.status, response.reason,
+                                    response.msg, None)
+
+        return response
+
+    def reuse_ratio(self):
+        if not self.requests:
+            return 0.0
+        return float(self.requests - self.connections) / self.requests
+
+class PooledResponse(object):
+    """ response wrapper which hands its connection back to the pool once
+        the body is fully read """
+
+    def __init__(self, pool, host, port, conn, response):
+        self.pool = pool
+        self.host = host
+        self.port = port
+        self.conn = conn
+        self.response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.msg = response.msg
+
+    def read(self, amt=None):
+        return self.response.read(amt)
+
+    def close(self):
+        if self.conn is None:
+            return
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool.release(self.host, self.port, self.conn)
+        else:
+            self.conn.close()
+        self.conn = None
+
+HttpPool = HttpConnPool()
+
+class ResponseCache(object):
+    """ on-disk cache of introspect responses keyed by host, port and
+        request path. Entries are zlib compressed, expire after ttl seconds
+        and the least recently used ones are evicted once the directory
+        grows beyond max_size bytes. A file's mtime is its store time and
+        its atime the time it was last served """
+
+    def __init__(self, directory, ttl, max_size):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+
+    def _file(self, host, port, path):
+        key = hashlib.sha1('%s:%s/%s' % (host, port, path)).hexdigest()
+        return os.path.join(self.directory, key + '.z')
+
+    def get(self, host, port, path):
+        filename = self._file(host, port, path)
+        try:
+            stored = os.stat(filename).st_mtime
+            now = time.time()
+            if now - stored > self.ttl:
+                os.remove(filename)
+                return None
+            with open(filename, 'rb') as f:
+                body = zlib.decompress(f.read())
+            os.utime(filename, (now, stored))
+            return body
+        except (OSError, IOError, zlib.error):
+            return None
+
+    def put(self, host, port, path, body):
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(zlib.compress(body))
+            os.rename(tmp, self._file(host, port, path))
+            self.evict()
+        except (OSError, IOError) as e:
+            if debug: print "DEBUG: failed to cache %s: %s" % (path, e)
+
+    def evict(self):
+        entries = []
+        total = 0
+        now = time.time()
+        for name in os.listdir(self.directory):
+            if not name.endswith('.z'):
+                continue
+            filename = os.path.join(self.directory, name)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            if now - st.st_mtime > self.ttl:
+                self._remove(filename)
+                continue
+            entries.append((st.st_atime, st.st_size, filename))
+            total += st.st_size
+
+        entries.sort()
+        for atime, size, filename in entries:
+            if total <= self.max_size:
+                break
+            self._remove(filename)
+            total -= size
+
+    @staticmethod
+    def _remove(filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+class SnapshotArchive(object):
+    """ gzipped tar of every page fetched by a command, for offline
+        replay with --file. index.json keeps the request path chain with
+        host, size and timing of each page, pages/NNNNN.xml the bodies """
+
+    loaded = {}
+
+    def __init__(self, filename, mode):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.tar = tarfile.open(filename, mode)
+        self.pages = []
+        self.members = {}
+        self.start = time.time()
+
+    @classmethod
+    def create(cls, filename):
+        archive = cls(filename, 'w:gz')
+        archive.command = sys.argv[1:]
+        return archive
+
+    @classmethod
+    def load(cls, filename):
+        if filename not in cls.loaded:
+            archive = cls(filename, 'r:gz')
+            index = json.load(archive.tar.extractfile('index.json'))
+            archive.command = index.get('command', [])
+            archive.pages = index['pages']
+            for page in archive.pages:
+                archive.members.setdefault(page['path'], page['file'])
+            cls.loaded[filename] = archive
+        return cls.loaded[filename]
+
+    def _addfile(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = time.time()
+        self.tar.addfile(info, StringIO(data))
+
+    def add(self, host, port, root, path, body, start, end):
+        """ record body of path, fetched as part of the chain of root """
+        with self.lock:
+            name = 'pages/%05d.xml' % (len(self.pages) + 1)
+            self._addfile(name, body)
+            self.pages.append({'host': host, 'port': port, 'root': root,
+                               'path': path, 'file': name,
+                               'bytes': len(body),
+                               'offset': round(start - self.start, 6),
+                               'elapsed': round(end - start, 6)})
+
+    def close(self):
+        with self.lock:
+            self._addfile('index.json', json.dumps(
+                {'version': version, 'command': self.command,
+                 'pages': self.pages}, indent=1))
+            self.tar.close()
+
+    def resolve(self, path):
+        """ map the first request of a command to a recorded chain """
+        if path in self.members or not self.pages:
+            return path
+        root = self.pages[0]['root']
+        sys.stderr.write("Warning: %s not in archive, replaying %s\n" %
+                         (path, root))
+        return root
+
+    def chain(self, root):
+        """ request paths recorded for root, in the order they were
+            fetched: the first host's pages up to the next request of root.
+            Empty if root was never requested """
+        paths = []
+        host = None
+        for page in self.pages:
+            if page['root'] != root or \
+                    (host is not None and page['host'] != host):
+                continue
+            if paths and page['path'] == root:
+                break
+            host = page['host']
+            paths.append(page['path'])
+        return paths
+
+    def read(self, path):
+        with self.lock:
+            if path not in self.members:
+                raise IntrospectError('Page not found in archive',
+                                      self.filename + ':' + path,
+                                      'Recorded command: ist ' +
+                                      ' '.join(self.command))
+            return self.tar.extractfile(self.members[path]).read()
+
+class RecordStore(object):
+    """ --snapshot: SQLite database of the records selected by commands.
+        Each Sandesh type gets a table with a column per child tag, added
+        as new tags show up. Struct fields and lists of structs go to the
+        table of their own type, linked to the row holding them by _parent
+        (its _id) and _field, and the field itself keeps their count. Each
+        command adds a row to runs, referred to by _run. Records may come
+        from worker threads (ctr route check), rows are written one record
+        at a time """
+
+    keys = ('uuid', 'name', 'index', 'prefix', 'label', 'src_ip',
+            'nh_index', '_parent')
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.db.execute('CREATE TABLE IF NOT EXISTS runs (id INTEGER '
+                        'PRIMARY KEY, time TEXT, version TEXT, command TEXT)')
+        self.run = self.db.execute(
+            'INSERT INTO runs (time, version, command) VALUES (?, ?, ?)',
+            (datetime.now().isoformat(' '), version,
+             ' '.join(sys.argv[1:]))).lastrowid
+        self.columns = {}
+        self.statements = {}
+
+    @staticmethod
+    def quote(name):
+        return '"%s"' % name.replace('"', '""')
+
+    def add(self, ist, entry):
+        """ store a record selected from ist, unless it was already stored
+            as part of an enclosing one. Elements are selected in document
+            order, so the structs stored with the last record of the thread
+            are all there is to check. They are held, not their id(), which
+            lxml would reuse once a streamed record is freed """
+        if not etree.iselement(entry) or not len(entry):
+            return
+        stored = getattr(self.local, 'stored', None)
+        if stored is not None and entry in stored:
+            return
+        self.local.stored = set()
+        with self.lock:
+            self.insert(entry, ist.host, ist.port, None, None)
+
+    def insert(self, entry, host, port, parent, field):
+        self.local.stored.add(entry)
+        names = ['_run', '_host', '_port', '_parent', '_field']
+        values = [self.run, host, port, parent, field]
+        nested = []
+        for e in entry:
+            if e.tag == 'more':
+                continue
+            names.append(e.tag)
+            if not len(e):
+                values.append(self.value(Introspect.textToObj(
+                    e.text, e.get('type'))))
+                continue
+            structs = self.structs(e)
+            if structs is None:
+                values.append(self.value(Introspect.elementToObj(e)))
+            else:
+                values.append(len(structs))
+                nested.extend((e.tag, s) for s in structs)
+        rowid = self.write(entry.tag, tuple(names), values)
+        for tag, s in nested:
+            self.insert(s, host, port, rowid, tag)
+
+    @staticmethod
+    def structs(e):
+        """ struct elements held by field e, None for other fields. Records
+            already cleared by --stream are left out """
+        kind = e.get('type')
+        if kind == 'list':
+            e = e.find('list')
+        elif kind != 'struct':
+            return None
+        return [s for s in e if s.tag != 'more' and len(s)] or None
+
+    @staticmethod
+    def value(obj):
+        if isinstance(obj, (list, dict)):
+            return json.dumps(obj)
+        if isinstance(obj, (int, long)) and not -1 << 63 <= obj < 1 << 63:
+            return str(obj)
+        return obj
+
+    def write(self, table, names, values):
+        """ insert a row into table, creating the table, its new columns
+            and their indexes first """
+        if table not in self.columns:
+            self.db.execute('CREATE TABLE IF NOT EXISTS %s ("_id" INTEGER '
+                            'PRIMARY KEY, "_run" INTEGER)'
+                            % self.quote(table))
+            self.columns[table] = set(
+                c[1] for c in self.db.execute('PRAGMA table_info(%s)'
+                                              % self.quote(table)))
+        sql = self.statements.get((table, names))
+        if sql is None:
+            columns = self.columns[table]
+            for name in names:
+                if name in columns:
+                    continue
+                self.db.execute('ALTER TABLE %s ADD COLUMN %s'
+                                % (self.quote(table), self.quote(name)))
+                if name in self.keys:
+                    self.db.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)'
+                                    % (self.quote(table + '_' + name),
+                                       self.quote(table), self.quote(name)))
+                columns.add(name)
+            sql = self.statements[(table, names)] = \
+                'INSERT INTO %s (%s) VALUES (%s)' % (
+                    self.quote(table), ', '.join(map(self.quote, names)),
+                    ', '.join('?' * len(names)))
+        return self.db.execute(sql, values).lastrowid
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+class Timings(object):
+    """ --timings: where the time of a command goes. Each page records its
+        url, size, time to first byte, latency (first byte plus body
+        transfer) and parse time; printers record their render time, less
+        the fetch and parse time they spend on the main thread themselves
+        (stream mode). Summary goes to stderr, details to an optional
+        JSON file """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.thread = threading.current_thread()
+        self.pages = []
+        self.last = {}
+        self.render = OrderedDict()
+        self.depth = 0
+        self.busy = 0.0
+
+    def _spent(self, seconds):
+        # only fetch and parse blocking the printers count against them
+        if threading.current_thread() is self.thread:
+            self.busy += seconds
+
+    def page(self, url, source, ttfb, latency=None, size=0):
+        """ record a page whose first byte came after ttfb seconds """
+        page = OrderedDict([('url', url), ('source', source),
+                            ('bytes', size), ('ttfb', ttfb),
+                            ('latency', latency or ttfb), ('parse', 0.0)])
+        with self.lock:
+            self.pages.append(page)
+            self.last[url] = page
+        self._spent(page['latency'])
+        return page
+
+    def received(self, page, size, seconds):
+        page['bytes'] += size
+        page['latency'] += seconds
+        self._spent(seconds)
+
+    def parsed(self, url, seconds):
+        with self.lock:
+            page = self.last.get(url)
+        if page is None:
+            page = self.page(url, 'file', 0.0)
+        page['parse'] += seconds
+        self._spent(seconds)
+
+    def events(self, url, events):
+        """ iterparse events of url, accounting the time spent parsing
+            less the body transfer done meanwhile """
+        while True:
+            start, busy = time.time(), self.busy
+            event = next(events, None)
+            self.parsed(url, time.time() - start - (self.busy - busy))
+            if event is None:
+                return
+            yield event
+
+    def waited(self, seconds):
+        """ main thread blocked on pages fetched by another thread """
+        self._spent(seconds)
+
+    def rendering(self, name, func, *args, **kwargs):
+        """ run printer func, accounting its time to name """
+        if self.depth or threading.current_thread() is not self.thread:
+            return func(*args, **kwargs)
+        self.depth += 1
+        start, busy = time.time(), self.busy
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.depth -= 1
+            elapsed = time.time() - start - (self.busy - busy)
+            self.render[name] = self.render.get(name, 0.0) + elapsed
+
+    @staticmethod
+    def peakRSS():
+        """ peak resident set size in bytes (ru_maxrss is in KB on Linux,
+            in bytes on macOS) """
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == 'darwin' else rss << 10
+
+    def report(self):
+        total = time.time() - self.start
+        rss = Timings.peakRSS()
+        pages = list(self.pages)
+        size = sum(page['bytes'] for page in pages)
+        out = sys.stderr
+        out.write("Timings:\n")
+        out.write("  pages:    %d, %d bytes\n" % (len(pages), size))
+        out.write("  fetch:    %.3fs, ttfb %.3fs (sum over pages)\n" %
+                  (sum(page['latency'] for page in pages),
+                   sum(page['ttfb'] for page in pages)))
+        out.write("  parse:    %.3fs\n" %
+                  sum(page['parse'] for page in pages))
+        for name, elapsed in self.render.iteritems():
+            out.write("  render:   %.3fs %s\n" % (elapsed, name))
+        out.write("  total:    %.3fs\n" % total)
+        out.write("  peak RSS: %.1f MB\n" % (rss / 1048576.0))
+        slowest = sorted(pages, key=lambda page: page['latency'] +
+                         page['parse'], reverse=True)[:5]
+        if len(pages) > 1:
+            out.write("  slowest pages:\n")
+            out.write("    %-9s %-9s %-9s %-10s %s\n" %
+                      ('latency', 'ttfb', 'parse', 'bytes', 'url'))
+            for page in slowest:
+                out.write("    %-9.3f %-9.3f %-9.3f %-10d %s\n" %
+                          (page['latency'], page['ttfb'], page['parse'],
+                           page['bytes'], page['url']))
+        if self.filename:
+            try:
+                for page in pages:
+                    for key in ('ttfb', 'latency', 'parse'):
+                        page[key] = round(page[key], 6)
+                with open(self.filename, 'w') as f:
+                    json.dump(OrderedDict([
+                        ('version', version),
+                        ('command', sys.argv[1:]),
+                        ('start', datetime.fromtimestamp(
+                            self.start).isoformat()),
+                        ('total', round(total, 6)),
+                        ('peak_rss', rss),
+                        ('render', OrderedDict(
+                            (name, round(elapsed, 6)) for name, elapsed
+                            in self.render.iteritems())),
+                        ('pages', pages)]), f, indent=1)
+                    f.write('\n')
+            except IOError as e:
+                out.write("Failed to write %s: %s\n" %
+                          (self.filename, e.strerror))
+
+class TimedResponse(object):
+    """ response wrapper which accounts body transfer to its page """
+
+    def __init__(self, response, page):
+        self.response = response
+        self.page = page
+
+    def read(self, amt=None):
+        start = time.time()
+        data = self.response.read() if amt is None else \
+               self.response.read(amt)
+        timings.received(self.page, len(data), time.time() - start)
+        return data
+
+    def close(self):
+        self.response.close()
+
+def timed(func):
+    """ printer decorator, accounts its render time with --timings """
+    def run(*args, **kwargs):
+        if not timings:
+            return func(*args, **kwargs)
+        return timings.rendering(func.__name__, func, *args, **kwargs)
+    run.__name__ = func.__name__
+    run.__doc__ = func.__doc__
+    return run
+
+class AsyncRequest(asyncore.dispatcher):
+    """ one non-blocking HTTP GET, the response is read until the server
+        closes the connection and handed to the engine """
+
+    def __init__(self, engine, chain, path, address):
+        asyncore.dispatcher.__init__(self, map=engine.map)
+        self.engine = engine
+        self.chain = chain
+        self.path = path
+        self.start = time.time()
+        self.first = None
+        self.data = []
+        self.finished = False
+        ist = chain.ist
+        self.out = ('GET /%s HTTP/1.1\r\nHost: %s:%d\r\n'
+                    'Connection: close\r\n\r\n' %
+                    (path.replace(' ', '%20'), ist.host, ist.port))
+        self.create_socket(address[0], socket.SOCK_STREAM)
+        try:
+            self.connect(address[1])
+        except socket.error:
+            self.close()
+            raise
+
+    def writable(self):
+        return not self.connected or bool(self.out)
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        self.out = self.out[self.send(self.out):]
+
+    def handle_read(self):
+        data = self.recv(1 << 16)
+        if data:
+            if self.first is None:
+                self.first = time.time()
+            self.data.append(data)
+
+    def handle_close(self):
+        # also called when a connect fails
+        err = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        self.finish(socket.error(err, os.strerror(err)) if err else None)
+
+    def handle_error(self):
+        self.finish(sys.exc_info()[1])
+
+    def finish(self, error):
+        if not self.finished:
+            self.finished = True
+            self.close()
+            self.engine.done(self, error)
+
+class AsyncChain(object):
+    """ pagination state of one get(): pages are requested one after
+        another, while other chains run in between. pages lists
+        (path, body) like PageFetcher yields """
+
+    def __init__(self, ist, path):
+        self.ist = ist
+        self.path = path
+        self.pages = []
+        self.error = None
+
+class AsyncEngine(object):
+    """ runs the pagination of many (introspect, path) requests at once
+        on one asyncore loop, with at most `limit` HTTP requests in flight.
+        Pages are followed with nextPage() like PageFetcher does """
+
+    def __init__(self, limit=Default_Workers, timeout=Async_Timeout):
+        self.limit = max(1, limit)
+        self.timeout = timeout
+        self.map = {}
+        self.queue = []
+        self.active = set()
+        self.addresses = {}
+
+    def run(self, jobs):
+        """ jobs lists (introspect, path), returns their AsyncChain """
+        chains = [AsyncChain(ist, path) for ist, path in jobs]
+        for chain in chains:
+            self.submit(chain, chain.path)
+        while self.queue or self.active:
+            while self.queue and len(self.active) < self.limit:
+                self.start(*self.queue.pop(0))
+            asyncore.loop(timeout=0.1, map=self.map, count=1,
+                          use_poll=hasattr(select, 'poll'))
+            now = time.time()
+            for request in list(self.active):
+                if now - request.start > self.timeout:
+                    request.finish(socket.timeout('timed out'))
+        return chains
+
+    def submit(self, chain, path):
+        ist = chain.ist
+        if cache:
+            start = time.time()
+            body = cache.get(ist.host, ist.port, path)
+            if body is not None:
+                if debug: print "DEBUG: cache hit for url " + \
+                                ist.host_url + path
+                if timings:
+                    timings.page(ist._url(path), 'cache',
+                                 time.time() - start, size=len(body))
+                self.received(chain, path, body)
+                return
+        self.queue.append((chain, path))
+
+    def start(self, chain, path):
+        ist = chain.ist
+        if debug: print "DEBUG: retrieving url " + ist.host_url + path
+        try:
+            key = (ist.host, ist.port)
+            if key not in self.addresses:
+                info = socket.getaddrinfo(ist.host, ist.port, 0,
+                                          socket.SOCK_STREAM)[0]
+                self.addresses[key] = (info[0], info[4])
+            request = AsyncRequest(self, chain, path, self.addresses[key])
+        except (socket.error, socket.gaierror) as e:
+            self.fail(chain, path, e)
+            return
+        self.active.add(request)
+
+    def done(self, request, error):
+        self.active.discard(request)
+        chain, path = request.chain, request.path
+        if error is not None:
+            self.fail(chain, path, error)
+            return
+        data = ''.join(request.data)
+        head, sep, body = data.partition('\r\n\r\n')
+        status = head.split('\r\n', 1)[0].split(None, 2)
+        if not sep or len(status) < 2:
+            self.fail(chain, path, socket.error(errno.ECONNRESET,
+                                    os.strerror(errno.ECONNRESET)))
+            return
+        if status[1] != '200':
+            chain.error = IntrospectError(
+                    'The server couldn\'t fulfill the request.',
+                    chain.ist.host_url + path, 'Error code:  %s' % status[1])
+            return
+        headers = {}
+        for line in head.split('\r\n')[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = AsyncEngine.dechunk(body)
+        elif 'content-length' in headers:
+            body = body[:int(headers['content-length'])]
+        ist = chain.ist
+        end = time.time()
+        if cache:
+            cache.put(ist.host, ist.port, path, body)
+        if capture:
+            capture.add(ist.host, ist.port, chain.path, path, body,
+                        request.start, end)
+        if timings:
+            timings.page(ist._url(path), 'http',
+                         (request.first or end) - request.start,
+                         end - request.start, len(body))
+        self.received(chain, path, body)
+
+    def received(self, chain, path, body):
+        next_path, keep = nextPage(path, body, True)
+        if keep:
+            chain.pages.append((path, body))
+        else:
+            chain.pages = []
+        if next_path:
+            self.submit(chain, next_path)
+
+    def fail(self, chain, path, error):
+        chain.error = IntrospectError('Failed to reach destination',
+                                      chain.ist.host_url + path,
+                                      'Reason:  %s' % error)
+
+    @staticmethod
+    def dechunk(body):
+        chunks = []
+        while body:
+            size, _, body = body.partition('\r\n')
+            size = int(size.split(';')[0], 16)
+            if not size:
+                break
+            chunks.append(body[:size])
+            body = body[size + 2:]
+        return ''.join(chunks)
+
+class PageFetcher(threading.Thread):
+    """ background producer for a next_batch/Pagination page chain.
+        The next page is requested as soon as its link is found in the raw
+        body of the current one, while the caller parses and prints.
+        At most Pipeline_Depth pages are queued ahead of the caller """
+
+    def __init__(self, introspect, path, follow_all=True,
+                 depth=Pipeline_Depth):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.introspect = introspect
+        self.path = path
+        self.follow_all = follow_all
+        self.queue = Queue.Queue(depth)
+        self.stopped = False
+        self.start()
+
+    def run(self):
+        path = self.path
+        try:
+            while path and not self.stopped:
+                body = self.introspect._fetch(path)
+                next_path, keep = nextPage(path, body, self.follow_all)
+                if keep:
+                    self.queue.put((path, body))
+                path = next_path
+        except BaseException as e:
+            self.queue.put(e)
+        self.queue.put(None)
+
+    def next(self):
+        """ return next (path, body), or None once the chain is done """
+        if self.stopped:
+            return None
+        if timings:
+            start = time.time()
+            page = self.queue.get()
+            timings.waited(time.time() - start)
+        else:
+            page = self.queue.get()
+        if isinstance(page, BaseException):
+            self.stopped = True
+            raise page
+        if page is None:
+            self.stopped = True
+        return page
+
+    def __iter__(self):
+        while True:
+            page = self.next()
+            if page is None:
+                return
+            yield page
+
+    def stop(self):
+        """ abandon the rest of the chain """
+        self.stopped = True
+        # unblock the producer if it waits on a full queue
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Queue.Empty:
+                break
+
+class ArchivePages(object):
+    """ PageFetcher look-alike replaying the page chain recorded in an
+        archive, whatever mode it was captured in: a default capture holds
+        the first page and the 'all' page, a --stream or --limit one the
+        next_page chain. Pages replaced by a recorded 'all' page are
+        skipped, links are only followed for requests never recorded """
+
+    def __init__(self, introspect, path):
+        self.pages = self._pages(introspect, path)
+        self.stopped = False
+
+    @staticmethod
+    def _pages(introspect, path):
+        recorded = introspect.archive.chain(path)
+        if not recorded:
+            while path:
+                body = introspect._fetch(path)
+                next_path, _ = nextPage(path, body, False)
+                yield path, body
+                path = next_path
+            return
+        for path in recorded:
+            body = introspect._fetch(path)
+            next_path, keep = nextPage(path, body, True)
+            if keep or next_path not in recorded:
+                yield path, body
+
+    def next(self):
+        """ return next (path, body), or None once the chain is done """
+        if self.stopped:
+            return None
+        page = next(self.pages, None)
+        if page is None:
+            self.stopped = True
+        return page
+
+    def __iter__(self):
+        while True:
+            page = self.next()
+            if page is None:
+                return
+            yield page
+
+    def stop(self):
+        """ abandon the rest of the chain """
+        self.stopped = True
+
+class StreamTable(object):
+    """ PrettyTable look-alike which prints rows as they are added.
+        Column widths come from the header and the first `sample` rows,
+        capped at max_width, so tables up to `sample` rows print exactly as
+        PrettyTable does. Later cells wider than their column overflow it
+        rather than being split: lines beyond max_width are only wrapped
+        at spaces, so addresses, uuids and names print whole. No row is
+        kept once printed """
+
+    def __init__(self, fields, max_width, sample=Table_Sample):
+        self.fields = fields
+        self.max_width = max_width
+        self.sample = sample
+        self.rows = []
+        self.widths = None
+
+    def add_row(self, row):
+        if len(row) != len(self.fields):
+            raise Exception("Row has incorrect number of values, "
+                            "(actual) %d!=%d (expected)" %
+                            (len(row), len(self.fields)))
+        row = [unicode(value) for value in row]
+        if self.widths is None:
+            self.rows.append(row)
+            if len(self.rows) >= self.sample:
+                self._start()
+        else:
+            self._write(row)
+
+    def close(self):
+        """ print the bottom rule, or the whole table if it was short """
+        if self.widths is None:
+            self._start()
+        print self.hrule
+        sys.stdout.flush()
+
+    def _start(self):
+        self.widths = [len(field) for field in self.fields]
+        for row in self.rows:
+            for i, value in enumerate(row):
+                size = max(len(line) for line in value.split('\n'))
+                self.widths[i] = max(self.widths[i],
+                                     min(size, self.max_width))
+        self.hrule = '+' + '+'.join('-' * (w + 2) for w in self.widths) + '+'
+        print self.hrule
+        self._write(self.fields)
+        print self.hrule
+        for row in self.rows:
+            self._write(row)
+        self.rows = []
+
+    def _write(self, row):
+        cells = []
+        for value, width in zip(row, self.widths):
+            lines = []
+            for line in value.split('\n'):
+                if len(line) > self.max_width:
+                    line = textwrap.fill(line, self.max_width,
+                                         break_long_words=False,
+                                         break_on_hyphens=False)
+                lines.extend(line.split('\n'))
+            cells.append(lines)
+        for y in range(max(len(lines) for lines in cells)):
+            print '|' + '|'.join(
+                ' ' + (lines[y] if y < len(lines) else '').ljust(width) + ' '
+                for lines, width in zip(cells, self.widths)) + '|'
+
+class TextSink(object):
+    """ buffered stdout writer for text output. Text is written out in
+        blocks of about size bytes and trailing blanks are held back until
+        more text follows, so end() leaves exactly what
+        'print text.rstrip()' would. One sink takes any number of texts,
+        ended one by one """
+
+    def __init__(self, size=1 << 16):
+        self.size = size
+        self.used = 0
+        self.block = []
+        # block[:ended] is ended text, only what follows may be stripped
+        self.ended = 0
+        self.pending = ''
+        self.encoding = sys.stdout.encoding or sys.getdefaultencoding()
+
+    def write(self, text):
+        self.block.append(text)
+        self.used += len(text)
+        if self.used >= self.size:
+            self.flush()
+
+    def end(self):
+        """ drop the trailing blanks of the current text, and end it with
+            a newline """
+        block = self.block
+        while len(block) > self.ended:
+            text = block[-1].rstrip()
+            if text:
+                block[-1] = text
+                break
+            block.pop()
+        else:
+            if not self.ended:
+                self.pending = ''
+        block.append('\n')
+        self.ended = len(block)
+        self.used += 1
+        if self.used >= self.size:
+            self.flush()
+
+    def flush(self):
+        done = ''.join(self.block[:self.ended])
+        data = ''.join(self.block[self.ended:])
+        self.block = []
+        self.ended = 0
+        self.used = 0
+        text = data.rstrip()
+        if done or text:
+            out = self.pending + done + text
+            if isinstance(out, unicode):
+                out = out.encode(self.encoding)
+            sys.stdout.write(out)
+            self.pending = data[len(text):]
+        else:
+            self.pending += data
+
+    def close(self):
+        self.end()
+        self.flush()
+
+class RecordWriter(object):
+    """ one line per record for scripts: jsonl objects, or csv/tsv rows
+        under a header line. Nested lists and structs are kept as json
+        in csv/tsv cells """
+
+    formats = ('jsonl', 'csv', 'tsv')
+
+    def __init__(self, format, fields):
+        self.format = format
+        self.fields = fields
+        if format == 'csv':
+            self.csv = csv.writer(sys.stdout, lineterminator='\n')
+        if format != 'jsonl':
+            self.writeRow(fields)
+
+    def write(self, record):
+        if self.format == 'jsonl':
+            sys.stdout.write(json.dumps(record) + '\n')
+        else:
+            self.writeRow([self.cell(record.get(field))
+                           for field in self.fields])
+
+    def writeRow(self, row):
+        if self.format == 'csv':
+            self.csv.writerow(row)
+        else:
+            sys.stdout.write('\t'.join(
+                cell.replace('\\', '\\\\').replace('\t', '\\t')
+                    .replace('\n', '\\n').replace('\r', '\\r')
+                for cell in row) + '\n')
+
+    @staticmethod
+    def cell(value):
+        if value is None:
+            return ''
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+        if isinstance(value, (list, dict)):
+            return json.dumps(value)
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return str(value)
+
+class RouteTrie(object):
+    """ path compressed binary trie of inet or inet6 route prefixes for
+        longest prefix match. A lookup walks at most one node per bit of
+        the address, whatever the number of routes. Nodes are lists of
+        [key, prefix length, value, child 0, child 1] """
+
+    def __init__(self, family):
+        if family == 'inet6':
+            self.af, self.bits = socket.AF_INET6, 128
+        else:
+            self.af, self.bits = socket.AF_INET, 32
+        self.root = [0, 0, None, None, None]
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def key(self, addr):
+        if self.af == socket.AF_INET:
+            addr = addr.split(':')[-1]  # strip RD info if any
+            return struct.unpack('!L', socket.inet_aton(addr))[0]
+        upper, lower = struct.unpack('!QQ', socket.inet_pton(self.af, addr))
+        return upper << 64 | lower
+
+    def insert(self, addr, plen, value):
+        """ add addr/plen, replacing the value of the same prefix """
+        bits = self.bits
+        key = self.key(addr) & ~((1 << (bits - plen)) - 1)
+        node = self.root
+        while True:
+            if node[1] == plen:
+                if node[2] is None:
+                    self.size += 1
+                node[2] = value
+                return
+            slot = 3 + (key >> (bits - 1 - node[1]) & 1)
+            child = node[slot]
+            if child is None:
+                node[slot] = [key, plen, value, None, None]
+                self.size += 1
+                return
+            common = min(plen, child[1], bits - (key ^ child[0]).bit_length())
+            if common == child[1]:
+                node = child
+                continue
+            # split the edge to child at the first differing bit
+            split = [key & ~((1 << (bits - common)) - 1), common,
+                     None, None, None]
+            split[3 + (child[0] >> (bits - 1 - common) & 1)] = child
+            node[slot] = split
+            if common == plen:
+                split[2] = value
+            else:
+                split[3 + (key >> (bits - 1 - common) & 1)] = \
+                        [key, plen, value, None, None]
+            self.size += 1
+            return
+
+    def lookup(self, addr):
+        """ value of the longest prefix containing addr, or None """
+        bits = self.bits
+        key = self.key(addr)
+        best = None
+        node = self.root
+        while node is not None:
+            plen = node[1]
+            if plen and (key ^ node[0]) >> (bits - plen):
+                break
+            if node[2] is not None:
+                best = node[2]
+            if plen == bits:
+                break
+            node = node[3 + (key >> (bits - 1 - plen) & 1)]
+        return best
+
 class Introspect:
     def __init__ (self, host, port, filename):
 
+        self.host = host
+        self.port = int(port)
         self.host_url = "http://" + host + ":" + str(port) + "/"
         self.filename = filename
+        self.archive = None
+        self.route_index = None
+        self.prefetched = {}
+        if filename and tarfile.is_tarfile(filename):
+            self.archive = SnapshotArchive.load(filename)
 
     def get (self, path):
         """ get introspect output """
+        if self.archive:
+            path = self.archive.resolve(path)
+        self.route_index = None
+        if path in self.prefetched:
+            self.usePages(path, self.prefetched.pop(path))
+            return
+        if (stream or limit is not None) and \
+                (self.archive or not self.filename):
+            # pages are fetched and parsed lazily by select()
+            self.path = path
+            self.output_etree = None
+            return
+        self.getAll(path)
+
+    def records(self, path, xpathExpr):
+        """ get path and yield records matching xpathExpr one at a time, as
+            in stream mode whatever --stream says, for commands going
+            through whole tables. An xml --file is parsed whole """
+        if self.filename and not self.archive:
+            self.get(path)
+        else:
+            if self.archive:
+                path = self.archive.resolve(path)
+            self.route_index = None
+            self.path = path
+            self.output_etree = None
+        return self._select(xpathExpr)
+
+    def getAll(self, path):
+        """ fetch and keep every page of path, also in stream mode """
+        self.path = path
         self.output_etree = []
+        self.route_index = None
 
         # load xml output from given file
-        if self.filename:
+        if self.filename and not self.archive:
             try:
-                print "Loadding from introspect xml %s" % self.filename
+                sys.stderr.write("Loadding from introspect xml %s\n" %
+                                 self.filename)
+                start = time.time()
                 self.output_etree.append(etree.parse(self.filename))
+                if timings:
+                    timings.parsed(self.filename, time.time() - start)
             except Exception as inst:
                 print "ERROR: parsing %s failed " % self.filename
                 print inst
                 sys.exit(1)
+        elif self.archive or pipeline:
+            for path, ISOutput in self.pageChain(path, follow_all=True):
+                self.output_etree.append(self._parse(path, ISOutput))
         else:
             while True:
-                url = self.host_url + path.replace(' ', '%20')
-                if debug: print "DEBUG: retrieving url " + url
-                try:
-                  response = urlopen(url)
-                except HTTPError as e:
-                    print 'The server couldn\'t fulfill the request.'
-                    print 'URL: ' + url
-                    print 'Error code: ', e.code
-                    sys.exit(1)
-                except URLError as e:
-                    print 'Failed to reach destination'
-                    print 'URL: ' + url
-                    print 'Reason: ', e.reason
-                    sys.exit(1)
-                else:
-                    ISOutput = response.read()
-                    response.close()
+                ISOutput = self._fetch(path)
 
-                self.output_etree.append(etree.fromstring(ISOutput))
+                self.output_etree.append(self._parse(path, ISOutput))
 
                 if 'Snh_PageReq?x=' in path:
                     break
@@ -102,7 +1295,8 @@ class Introspect:
                             self.output_etree = []
                             continue
                         else:
-                            print "Warning: all page in pagination is empty!"
+                            sys.stderr.write("Warning: all page in "
+                                             "pagination is empty!\n")
                             break
                     else:
                         break
@@ -121,91 +1315,500 @@ class Introspect:
         if debug:
             for tree in self.output_etree:
                 etree.dump(tree)
+            if not self.filename:
+                self._debugPool()
+
+    def prefetch(self, paths):
+        """ with --async, fetch independent requests concurrently ahead
+            of the get() calls which will use them """
+        if not asynchronous or self.filename or limit is not None:
+            return
+        for chain in AsyncEngine(workers).run([(self, p) for p in paths]):
+            # failed ones are left to get(), which reports the error
+            if chain.error is None:
+                self.prefetched[chain.path] = chain.pages
+
+    def usePages(self, path, pages):
+        """ make raw pages of path the current output, as get() would """
+        self.path = path
+        self.route_index = None
+        self.output_etree = [self._parse(page_path, body)
+                             for page_path, body in pages]
+        if debug:
+            for tree in self.output_etree:
+                etree.dump(tree)
+
+    def pageChain(self, path, follow_all):
+        """ pages of path fetched ahead by a PageFetcher, or replayed from
+            the archive as they were recorded """
+        if self.archive:
+            return ArchivePages(self, path)
+        return PageFetcher(self, path, follow_all)
+
+    def _url(self, path):
+        return self.host_url + path.replace(' ', '%20')
+
+    def _open(self, path):
+        """ send request for path and return the response """
+        url = self._url(path)
+        start = time.time()
+        if self.archive:
+            if debug: print "DEBUG: replaying url " + url
+            return self._timed(StringIO(self.archive.read(path)), url,
+                               'archive', start)
+        if cache:
+            body = cache.get(self.host, self.port, path)
+            if body is not None:
+                if debug: print "DEBUG: cache hit for url " + url
+                return self._timed(StringIO(body), url, 'cache', start)
+        if debug: print "DEBUG: retrieving url " + url
+        try:
+            response = HttpPool.urlopen(self.host, self.port,
+                                        '/' + path.replace(' ', '%20'))
+            first = time.time()
+            if not (cache or capture):
+                return self._timed(response, url, 'http', start, first)
+            try:
+                body = response.read()
+            finally:
+                response.close()
+            if cache:
+                cache.put(self.host, self.port, path, body)
+            if capture:
+                capture.add(self.host, self.port, self.path, path, body,
+                            start, time.time())
+            return self._timed(StringIO(body), url, 'http', start, first)
+        except urllib2.HTTPError as e:
+            raise IntrospectError('The server couldn\'t fulfill the request.',
+                                  url, 'Error code:  %s' % (e.code))
+        except urllib2.URLError as e:
+            raise IntrospectError('Failed to reach destination',
+                                  url, 'Reason:  %s' % (e.reason))
+
+    @staticmethod
+    def _timed(response, url, source, start, first=None):
+        """ with --timings, record the page and account its transfer """
+        if not timings:
+            return response
+        now = time.time()
+        page = timings.page(url, source, (first or now) - start, now - start)
+        return TimedResponse(response, page)
+
+    def _parse(self, path, body):
+        """ parse a page body, accounting the time with --timings """
+        if not timings:
+            return etree.fromstring(body)
+        start = time.time()
+        tree = etree.fromstring(body)
+        timings.parsed(self._url(path), time.time() - start)
+        return tree
+
+    def _fetch(self, path):
+        """ return the raw body of path """
+        response = self._open(path)
+        try:
+            return response.read()
+        finally:
+            response.close()
+
+    def _debugPool(self):
+        print ("DEBUG: http pool: %d requests over %d connections, "
+               "reuse ratio %.1f%%" % (HttpPool.requests,
+               HttpPool.connections, 100 * HttpPool.reuse_ratio()))
+
+    def select(self, xpathExpr, record=None):
+        """ yield elements matching xpathExpr from the fetched pages.
+            In stream mode records are parsed straight off the wire instead
+            and cleared as soon as the caller moves on to the next one.
+            With --limit, pages past the first limit elements aren't read.
+            When xpathExpr also selects other elements (e.g. table
+            headers), only those tagged record count toward the limit """
+        if limit is None:
+            return self._select(xpathExpr)
+        if record is None:
+            return islice(self._select(xpathExpr), limit)
+        return self._limited(self._select(xpathExpr), record)
 
+    @staticmethod
+    def _limited(elements, record):
+        left = limit
+        for element in elements:
+            yield element
+            if element.tag == record:
+                left -= 1
+                if not left:
+                    return
+
+    def _select(self, xpathExpr):
+        trees = self.output_etree
+        if trees is None:
+            spec = streamSpec(xpathExpr)
+            if spec:
+                for element in self.iterRecords(self.path, spec):
+                    if snapshot:
+                        snapshot.add(self, element)
+                    yield element
+                return
+            if limit is not None:
+                # page by page, rather than the whole output at once
+                trees = self.iterPages(self.path)
+            else:
+                # expression can't be matched per record, load whole output
+                self.getAll(self.path)
+                trees = self.output_etree
+
+        query = compiledXPath(xpathExpr)
+        for tree in trees:
+            for element in query(tree):
+                if snapshot:
+                    snapshot.add(self, element)
+                yield element
+
+    def iterPages(self, path):
+        """ parse and yield the pages of path one at a time, following
+            next_batch and next_page links instead of the 'all' page """
+        if self.archive or pipeline:
+            pages = self.pageChain(path, follow_all=False)
+            try:
+                for path, body in pages:
+                    yield self._parse(path, body)
+            finally:
+                pages.stop()
+            return
+        while path:
+            body = self._fetch(path)
+            next_path, _ = nextPage(path, body, False)
+            yield self._parse(path, body)
+            path = next_path
+
+    def iterRecords(self, path, spec):
+        """ iterparse pages of path and yield records whose tag is in spec.
+            spec maps record tag to a compiled predicate (or None).
+            next_batch and Pagination/next_page links are followed page by
+            page, so only one record is kept in memory at a time """
+        tags = tuple(spec.keys()) + ('next_batch', 'PageReqData')
+        chained = self.archive or pipeline
+        if chained:
+            # links are found by the fetcher thread, pages come pre-read
+            pages = self.pageChain(path, follow_all=False)
+            tags = tuple(spec.keys())
+        try:
+            while path:
+                if chained:
+                    page = pages.next()
+                    if page is None:
+                        break
+                    path, source = page[0], StringIO(page[1])
+                else:
+                    source = self._open(path)
+                next_path = None
+                events = etree.iterparse(source, tag=tags)
+                if timings:
+                    events = timings.events(self._url(path), events)
+                try:
+                    for event, elem in events:
+                        if elem.tag == 'next_batch':
+                            if elem.text and elem.get('link'):
+                                next_path = ('Snh_' + elem.get('link') +
+                                             '?x=' + elem.text)
+                            continue
+                        if elem.tag == 'PageReqData':
+                            next_page = elem.findtext('next_page')
+                            if next_page:
+                                next_path = 'Snh_PageReq?x=' + next_page
+                            continue
+                        # nested records are yielded with their outermost match
+                        parent = next(elem.iterancestors(elem.tag), None)
+                        if parent is not None:
+                            continue
+                        for record in elem.iter(elem.tag):
+                            match = spec[elem.tag]
+                            if match is None or match(record):
+                                yield record
+                        elem.clear()
+                        while elem.getprevious() is not None:
+                            del elem.getparent()[0]
+                finally:
+                    source.close()
+                if not chained:
+                    path = next_path
+        finally:
+            if chained:
+                pages.stop()
+        if debug: self._debugPool()
+
+    @timed
     def printTbl(self, xpathExpr, max_width=Default_Max_Width, *args):
         """ print introspect output in a table.
             args lists interested fields. """
-        items = []
-        for tree in self.output_etree:
-            items = items + tree.xpath(xpathExpr)
-        if len(items):
-            Introspect.dumpTbl(items, max_width, args)
+        Introspect.dumpTbl(self.select(xpathExpr), max_width, args)
+
+    def tblRecords(self, xpathExpr):
+        """ (leading cells, record) pairs, see MultiIntrospect """
+        for element in self.select(xpathExpr):
+            yield [], element
+
+    tblPrefix = []
+
+    @timed
+    def printRecords(self, xpathExpr, format, *args):
+        """ print introspect output one record per line for scripts.
+            args lists interested fields. """
+        Introspect.dumpRecords(self.tblRecords(xpathExpr), self.tblPrefix,
+                               format, args)
 
+    @timed
+    def printStaticRoutes(self, xpathExpr, format, columns):
+        """ StaticRouteInfo records, each under the ri_name of its
+            StaticRouteEntriesInfo """
+        Introspect.dumpRecords(
+            Introspect.staticRouteRecords(self.tblRecords(xpathExpr)),
+            self.tblPrefix + ['ri_name'], format, columns)
+
+    @staticmethod
+    def staticRouteRecords(records):
+        for values, entry in records:
+            ri_name = entry.findtext('ri_name')
+            for route in entry.iter('StaticRouteInfo'):
+                yield values + [ri_name], route
+
+    @timed
     def printText(self, xpathExpr):
         """ print introspect output in human readable text """
-        for tree in self.output_etree:
-            for element in tree.xpath(xpathExpr):
-                print Introspect.elementToStr('', element).rstrip()
-
-    def printTraceText(self, xpathExpr):
+        out = TextSink()
+        for element in self.select(xpathExpr):
+            Introspect.writeElement('', element, out.write)
+            out.end()
+        out.flush()
+
+    @timed
+    def printTraceText(self, xpathExpr, since=None, until=None):
         """ print introspect output in human readable text """
-        for tree in self.output_etree:
-            for element in tree.xpath(xpathExpr):
-                trace = element.text.split()
-                trace[0] = datetime.fromtimestamp(float(trace[0]) / 1e6).strftime('%Y-%m-%d [%H:%M:%S].%f')
-                element.text = ' '.join(trace)
-                print Introspect.elementToStr('\n', element).rstrip()
+        out = TextSink()
+        for usec, text in self.traceEntries(xpathExpr, since, until):
+            out.write('\n' + Introspect.traceToStr(usec, text) + '\n')
+        out.close()
+
+    def traceEntries(self, xpathExpr, since=None, until=None):
+        """ yield (timestamp in usec, text) of trace buffer elements within
+            since/until (usec). The timestamp is read off the raw text, so
+            entries out of range are dropped before any formatting """
+        for element in self.select(xpathExpr):
+            text = element.text
+            if not text:
+                continue
+            try:
+                usec = int(text.split(None, 1)[0])
+            except ValueError:
+                usec = None
+            if since is not None and (usec is None or usec < since):
+                continue
+            if until is not None and (usec is None or usec > until):
+                continue
+            yield usec, text
+
+    @staticmethod
+    def traceToStr(usec, text):
+        if usec is None:
+            return text
+        trace = text.split()
+        trace[0] = datetime.fromtimestamp(usec / 1e6).strftime(
+                        '%Y-%m-%d [%H:%M:%S].%f')
+        return ' '.join(trace)
 
     @staticmethod
     def dumpTbl(items, max_width, columns):
+        """ items may be any iterable of elements, rows are extracted
+            one at a time so streamed records can be released """
 
-        if not len(items):
-            return
+        tbl = None
+        for entry in items:
+            if tbl is None:
+                fields = Introspect.tblFields(entry, columns)
+                tbl = Introspect.newTbl(fields, max_width)
 
-        if len(columns):
-            fields = columns
-        else:
-            fields = [ e.tag for e in items[0] if e.tag != "more"]
+            tbl.add_row(Introspect.tblRow(entry, fields))
 
-        tbl = PrettyTable(fields)
+        if tbl is not None:
+            Introspect.closeTbl(tbl)
+
+    @staticmethod
+    def newTbl(fields, max_width):
+        """ in stream mode rows are printed as they come, see StreamTable """
+        if stream:
+            return StreamTable(fields, max_width)
+        tbl = prettytable.PrettyTable(fields)
         tbl.align = 'l'
         tbl.max_width = max_width
-        for entry in items:
-            row = []
+        return tbl
+
+    @staticmethod
+    def closeTbl(tbl):
+        if isinstance(tbl, StreamTable):
+            tbl.close()
+        else:
+            print tbl
+
+    @staticmethod
+    def dumpRecords(records, prefix, format, columns):
+        """ records yields (leading values, element) pairs, prefix names
+            the leading values. jsonl keeps every child of each record
+            unless columns are given, csv and tsv use the columns of the
+            first one like tables do """
+        out = None
+        for values, entry in records:
+            if out is None:
+                fields = None
+                if len(columns) or format != 'jsonl':
+                    fields = Introspect.tblFields(entry, columns)
+                out = RecordWriter(format, prefix + (fields or []))
+            out.write(Introspect.recordToObj(entry, fields, zip(prefix, values)))
+
+    @staticmethod
+    def recordToObj(entry, fields, items=[]):
+        """ fields of entry (all children when None) as plain data """
+        record = OrderedDict(items)
+        if fields is None:
+            for e in entry:
+                if e.tag != 'more':
+                    record[e.tag] = Introspect.elementToObj(e)
+        else:
+            children = {}
+            for e in entry:
+                children.setdefault(e.tag, e)
             for field in fields:
+                f = children.get(field)
+                if f is None and '/' in field:
+                    f = entry.find(field)
+                record[field] = None if f is None else \
+                                Introspect.elementToObj(f)
+        return record
+
+    @staticmethod
+    def elementToObj(etreenode):
+        """ convert sandesh element into python data: lists to lists,
+            structs to dicts and typed leaves to numbers or booleans """
+        if etreenode.tag == 'list':
+            return [Introspect.elementToObj(e) for e in etreenode
+                    if e.tag != 'more']
+
+        children = [e for e in etreenode if e.tag != 'more']
+        if not children:
+            return Introspect.textToObj(etreenode.text,
+                                        etreenode.get('type'))
+        if len(children) == 1 and (children[0].tag == 'list' or
+                                   etreenode.get('type') == 'struct'):
+            return Introspect.elementToObj(children[0])
+
+        obj = OrderedDict()
+        for e in children:
+            obj[e.tag] = Introspect.elementToObj(e)
+        return obj
+
+    @staticmethod
+    def textToObj(text, type):
+        if text is None:
+            return None
+        try:
+            if type in ('byte', 'i16', 'i32', 'i64', 'u16', 'u32', 'u64'):
+                return int(text)
+            if type == 'double':
+                return float(text)
+        except ValueError:
+            return text
+        if type == 'bool' and text in ('true', 'false'):
+            return text == 'true'
+        return text
+
+    @staticmethod
+    def tblFields(entry, columns):
+        """ table columns: given ones or all children of first entry """
+        if len(columns):
+            return list(columns)
+        return [ e.tag for e in entry if e.tag != "more"]
+
+    @staticmethod
+    def tblRow(entry, fields):
+        """ children of entry are indexed by tag in one pass, first one
+            wins like find(); only path columns still search the record """
+        children = {}
+        for e in entry:
+            children.setdefault(e.tag, e)
+        row = []
+        for field in fields:
+            f = children.get(field)
+            if f is None and '/' in field:
                 f = entry.find(field)
-                if f is not None:
-                    if f.text:
-                        row.append(f.text)
-                    elif list(f):
-                        for e in f:
-                            row.append(Introspect.elementToStr('', e).rstrip())
-                    else:
-                        row.append("n/a")
+            if f is not None:
+                if f.text:
+                    row.append(f.text)
+                elif list(f):
+                    for e in f:
+                        row.append(Introspect.elementToStr('', e).rstrip())
                 else:
-                    row.append("-")
-            tbl.add_row(row)
-        print tbl
+                    row.append("n/a")
+            else:
+                row.append("-")
+        return row
 
     @staticmethod
     def elementToStr(indent, etreenode):
         """ convernt etreenode sub-tree into string """
-        elementStr=''
+        lines = []
+        Introspect.writeElement(indent, etreenode, lines.append)
+        return ''.join(lines)
 
-        if etreenode.tag == 'more':   #skip more element
-            return elementStr
+    @staticmethod
+    def writeElement(indent, etreenode, write, chunk=256):
+        """ pass etreenode sub-tree to write() in chunks of lines. Lines
+            are gathered with list appends, a call to write() per line
+            costs more than formatting it """
+        lines = []
+        Introspect.elementLines(indent, etreenode, lines, write, chunk)
+        if lines:
+            write(''.join(lines))
 
-        if etreenode.text and etreenode.tag == 'element':
-            return indent + etreenode.text + "\n"
-        elif etreenode.text:
-            return indent + etreenode.tag + ': ' + \
-                    etreenode.text.replace('\n', '\n' + \
-                    indent + (len(etreenode.tag)+2)*' ') + "\n"
-        elif etreenode.tag != 'list':
-            elementStr += indent + etreenode.tag + "\n"
+    @staticmethod
+    def elementLines(indent, etreenode, lines, write, chunk):
+        tag = etreenode.tag
+
+        if tag == 'more':   #skip more element
+            return
+
+        text = etreenode.text
+        if text:
+            lines.append(Introspect.textLine(indent, tag, text))
+            return
+        elif tag != 'list':
+            lines.append(indent + tag + "\n")
 
         if 'type' in etreenode.attrib:
             if etreenode.attrib['type'] == 'list' and \
                     etreenode[0].attrib['size'] == '0':
-                return elementStr
+                return
 
+        if len(lines) >= chunk:
+            write(''.join(lines))
+            del lines[:]
+
+        indent += '  '
         for element in etreenode:
-            elementStr += Introspect.elementToStr(indent + '  ', element)
+            text = element.text
+            if not text:
+                Introspect.elementLines(indent, element, lines, write, chunk)
+            elif element.tag != 'more':
+                lines.append(Introspect.textLine(indent, element.tag, text))
 
-        return elementStr
+    @staticmethod
+    def textLine(indent, tag, text):
+        """ line of a field with a value """
+        if tag == 'element':
+            return indent + text + "\n"
+        return indent + tag + ': ' + \
+               text.replace('\n', '\n' + indent + (len(tag)+2)*' ') + "\n"
 
     @staticmethod
-    def pathToStr(indent, path, mode):
+    def pathToStr(indent, path, mode, now=None):
 
         path_info = ''
         if mode == 'raw':
@@ -213,11 +1816,11 @@ class Introspect:
                  path_info += Introspect.elementToStr(indent, item)
             return path_info.rstrip()
 
-        now = datetime.utcnow()
+        if now is None:
+            now = datetimeUsec(datetime.utcnow())
 
         path_modified = path.find("last_modified").text
-        t1 = datetime.strptime(path_modified, '%Y-%b-%d %H:%M:%S.%f')
-        path_age = str(now - t1).replace(',', '')
+        path_age = ageStr(now, timestampUsec(path_modified))
         path_proto = path.find("protocol").text
         path_source = path.find("source").text
         path_lp = path.find("local_preference").text
@@ -226,9 +1829,12 @@ class Introspect:
         path_label = path.find("label").text
         path_vn = path.find("origin_vn").text
         path_pri_tbl = path.find("primary_table").text
-        path_vn_path = str(path.xpath("origin_vn_path/list/element/text()"))
-        path_encap = str(path.xpath("tunnel_encap/list/element/text()"))
-        path_comm = str(path.xpath("communities/list/element/text()"))
+        path_vn_path = str(compiledXPath(
+                            "origin_vn_path/list/element/text()")(path))
+        path_encap = str(compiledXPath(
+                            "tunnel_encap/list/element/text()")(path))
+        path_comm = str(compiledXPath(
+                            "communities/list/element/text()")(path))
         path_sqn = path.find("sequence_no").text
         path_flags = path.find("flags").text
 
@@ -250,190 +1856,246 @@ class Introspect:
     def routeToStr(indent, route, mode):
 
         route_info = ''
-        now = datetime.utcnow()
+        now = datetimeUsec(datetime.utcnow())
 
         prefix = route.find("prefix").text
         prefix_modified = route.find("last_modified").text
-        t1 = datetime.strptime(prefix_modified, '%Y-%b-%d %H:%M:%S.%f')
-        prefix_age = str(now - t1).replace(',', '')
+        prefix_age = ageStr(now, timestampUsec(prefix_modified))
 
         route_info += "%s%s, age: %s, last_modified: %s" % \
                     (indent, prefix, prefix_age, prefix_modified)
 
         for path in route.xpath('.//ShowRoutePath'):
-            route_info += "\n" + Introspect.pathToStr(indent*2, path, mode)
+            route_info += "\n" + Introspect.pathToStr(indent*2, path, mode,
+                                                      now)
 
         return route_info.rstrip()
 
+    def routeIndex(self, xpathExpr, family):
+        """ RouteTrie of the routes fetched by the last get(), built on
+            first use and kept for further lookups """
+        if self.route_index is None or \
+                self.route_index[0] != (xpathExpr, family):
+            if self.output_etree is None:
+                # records are kept by the index, stream mode would free them
+                self.getAll(self.path)
+            index = RouteTrie(family)
+            for route in self._select(xpathExpr):
+                try:
+                    index.insert(route.find("src_ip").text,
+                                 int(route.find("src_plen").text), route)
+                except (socket.error, ValueError):
+                    if debug: print "DEBUG: skipping " + \
+                                    etree.tostring(route.find("src_ip"))
+            self.route_index = ((xpathExpr, family), index)
+        return self.route_index[1]
+
+    @timed
+    def resolveAddresses(self, addresses, vrf, max_width=Default_Max_Width):
+        """ longest prefix match of many addresses in vrf, the route
+            table of each family is fetched and indexed once """
+        requests = {
+            'inet': 'Snh_Inet4UcRouteReq?vrf_index=%d'
+                    '&src_ip=&prefix_len=&stale=',
+            'inet6': 'Snh_Inet6UcRouteReq?vrf_index=%d'
+                     '&src_ip=&prefix_len=&stale='
+        }
+        xpath = '//RouteUcSandeshData'
+        indexes = {}
+        for family, test in (('inet', is_ipv4), ('inet6', is_ipv6)):
+            if any(test(address) for address in addresses):
+                self.get(requests[family] % vrf)
+                indexes[family] = self.routeIndex(xpath, family)
+
+        tbl = Introspect.newTbl(['address', 'prefix', 'nh_type', 'dip',
+                                 'label'], max_width)
+        for address in addresses:
+            route = None
+            if is_ipv4(address):
+                route = indexes['inet'].lookup(address)
+            elif is_ipv6(address):
+                route = indexes['inet6'].lookup(address)
+            else:
+                sys.stderr.write("Invalid address: %s\n" % address)
+            if route is None:
+                tbl.add_row([address, '-', '-', '-', '-'])
+                continue
+            nh_types, dips, labels = [], [], []
+            for path in compiledXPath(".//PathSandeshData")(route):
+                nh = compiledXPath("nh/NhSandeshData")(path)
+                nh = nh[0] if len(nh) else None
+                nh_types.append(nh is not None and nh.findtext('type') or '-')
+                dips.append(nh is not None and nh.findtext('dip') or '-')
+                labels.append(path.findtext('label') or '-')
+            tbl.add_row([address, route.find("src_ip").text + '/' +
+                                  route.find("src_plen").text,
+                         ','.join(nh_types) or '-', ','.join(dips) or '-',
+                         ','.join(labels) or '-'])
+        Introspect.closeTbl(tbl)
+
+    @timed
     def showRoute_VR(self, xpathExpr, family, address, mode):
         """ method to show route output from vrouter intropsect """
         indent = ' ' * 4
 
-        ADDR_INET4 = 4
-        ADDR_INET6 = 6
-        ADDR_NONE = 0
-
-        addr_type = ADDR_NONE
-        if is_ipv4(address):
-            addr_type = ADDR_INET4
-        elif is_ipv6(address):
-            addr_type = ADDR_INET6
-
-        for tree in self.output_etree:
-            for route in tree.xpath(xpathExpr):
-                if 'inet' in family:
-                    prefix = route.find("src_ip").text + '/' + \
-                                route.find("src_plen").text
-                else:
-                    prefix = route.find("mac").text
-
-                if family == 'inet' and addr_type == ADDR_INET4:
-                    if not addressInNetwork(address, prefix):
-                        if debug: print "DEBUG: skipping " + prefix
-                        continue
-                elif family == 'inet6' and addr_type == ADDR_INET6:
-                    if not addressInNetwork6(address, prefix):
-                        if debug: print "DEBUG: skipping " + prefix
-                        continue
-
-                if mode == "raw":
-                    print Introspect.elementToStr('', route).rstrip()
-                    continue
-
-                output = prefix + "\n"
-
-                for path in route.xpath(".//PathSandeshData"):
-                    nh = path.xpath("nh/NhSandeshData")[0]
-
-                    peer = path.find("peer").text
-                    pref = path.xpath("path_preference_data/"
-                                      "PathPreferenceSandeshData/"
-                                      "preference")[0].text
+        routes = self.select(xpathExpr)
+        if (family == 'inet' and is_ipv4(address)) or \
+                (family == 'inet6' and is_ipv6(address)):
+            route = self.routeIndex(xpathExpr, family).lookup(address)
+            routes = [route] if route is not None else []
 
-                    path_info = "%s[%s] pref:%s\n" % (indent, peer, pref)
-
-                    path_info += indent + ' '
-                    nh_type = nh.find('type').text
-                    if nh_type == "interface":
+        for route in routes:
+            if 'inet' in family:
+                prefix = route.find("src_ip").text + '/' + \
+                            route.find("src_plen").text
+            else:
+                prefix = route.find("mac").text
+
+            if mode == "raw":
+                print Introspect.elementToStr('', route).rstrip()
+                continue
+
+            output = prefix + "\n"
+
+            for path in compiledXPath(".//PathSandeshData")(route):
+                nh = compiledXPath("nh/NhSandeshData")(path)[0]
+
+                peer = path.find("peer").text
+                pref = compiledXPath("path_preference_data/"
+                                     "PathPreferenceSandeshData/"
+                                     "preference")(path)[0].text
+
+                path_info = "%s[%s] pref:%s\n" % (indent, peer, pref)
+
+                path_info += indent + ' '
+                nh_type = nh.find('type').text
+                if nh_type == "interface":
+                    mac = nh.find('mac').text
+                    itf = nh.find("itf").text
+                    label = path.find("label").text
+                    path_info += ("to %s via %s, assigned_label:%s, "
+                                    % (mac, itf, label))
+
+                elif nh_type == "tunnel":
+                    tunnel_type = nh.find("tunnel_type").text
+                    dip = nh.find("dip").text
+                    sip = nh.find("sip").text
+                    label = path.find("label").text
+                    if nh.find('mac') is not None:
                         mac = nh.find('mac').text
-                        itf = nh.find("itf").text
-                        label = path.find("label").text
-                        path_info += ("to %s via %s, assigned_label:%s, "
-                                        % (mac, itf, label))
-
-                    elif nh_type == "tunnel":
-                        tunnel_type = nh.find("tunnel_type").text
-                        dip = nh.find("dip").text
-                        sip = nh.find("sip").text
-                        label = path.find("label").text
-                        if nh.find('mac') is not None:
-                            mac = nh.find('mac').text
-                            path_info += ("to %s via %s dip:%s "
-                                          "sip:%s label:%s, "
-                                          % (mac, tunnel_type, dip,
-                                             sip, label))
-                        else:
-                            path_info += ("via %s dip:%s sip:%s label:%s, "
-                                          % (tunnel_type, dip, sip, label))
-
-                    elif nh_type == "receive":
-                        itf = nh.find("itf").text
-                        path_info += "via %s, " % (itf)
-
-                    elif nh_type == "arp":
-                        try:
-                            mac = nh.find('mac').text
-                            itf = nh.find("itf").text
-                            path_info += "via %s, " % (mac)
-                        except:
-                            pass
+                        path_info += ("to %s via %s dip:%s "
+                                      "sip:%s label:%s, "
+                                      % (mac, tunnel_type, dip,
+                                         sip, label))
+                    else:
+                        path_info += ("via %s dip:%s sip:%s label:%s, "
+                                      % (tunnel_type, dip, sip, label))
 
-                    elif 'Composite' in str(nh_type):
-                        comp_nh = str(nh.xpath(".//itf/text()"))
-                        path_info += "via %s, " % (comp_nh)
+                elif nh_type == "receive":
+                    itf = nh.find("itf").text
+                    path_info += "via %s, " % (itf)
 
-                    elif 'vlan' in str(nh_type):
+                elif nh_type == "arp":
+                    try:
                         mac = nh.find('mac').text
                         itf = nh.find("itf").text
-                        path_info += "to %s via %s, " % (mac, itf)
-
-                    nh_index = nh.find("nh_index").text
-                    if nh.find("policy") is not None:
-                        policy = nh.find("policy").text
-                    else:
-                        policy = ''
-                    active_label = path.find("active_label").text
-                    vxlan_id = path.find("vxlan_id").text
-                    path_info += ("nh_index:%s , nh_type:%s, nh_policy:%s, "
-                                  "active_label:%s, vxlan_id:%s" %
-                                 (nh_index, nh_type, policy,
-                                  active_label, vxlan_id))
-
-                    if mode == "detail":
-                        path_info += "\n"
-                        path_info += indent + ' dest_vn:' + \
-                            str(path.xpath("dest_vn_list/list/element/text()"))
-                        path_info += ', sg:' + \
-                            str(path.xpath("sg_list/list/element/text()"))
-                        path_info += ', communities:' +  \
-                            str(path.xpath("communities/list/element/text()"))
-                    output += path_info + "\n"
-
-                print output.rstrip()
-
+                        path_info += "via %s, " % (mac)
+                    except:
+                        pass
+
+                elif 'Composite' in str(nh_type):
+                    comp_nh = str(nh.xpath(".//itf/text()"))
+                    path_info += "via %s, " % (comp_nh)
+
+                elif 'vlan' in str(nh_type):
+                    mac = nh.find('mac').text
+                    itf = nh.find("itf").text
+                    path_info += "to %s via %s, " % (mac, itf)
+
+                nh_index = nh.find("nh_index").text
+                if nh.find("policy") is not None:
+                    policy = nh.find("policy").text
+                else:
+                    policy = ''
+                active_label = path.find("active_label").text
+                vxlan_id = path.find("vxlan_id").text
+                path_info += ("nh_index:%s , nh_type:%s, nh_policy:%s, "
+                              "active_label:%s, vxlan_id:%s" %
+                             (nh_index, nh_type, policy,
+                              active_label, vxlan_id))
+
+                if mode == "detail":
+                    path_info += "\n"
+                    path_info += indent + ' dest_vn:' + \
+                        str(path.xpath("dest_vn_list/list/element/text()"))
+                    path_info += ', sg:' + \
+                        str(path.xpath("sg_list/list/element/text()"))
+                    path_info += ', communities:' +  \
+                        str(path.xpath("communities/list/element/text()"))
+                output += path_info + "\n"
+
+            print output.rstrip()
+
+    @timed
     def showRoute_CTR(self, last, mode):
         """ show route output from control node intropsect """
         indent = ' ' * 4
-        now = datetime.utcnow()
+        now = datetimeUsec(datetime.utcnow())
+        last_usec = last * 1000000 if last else None
         printedTbl = {}
         xpath_tbl = '//ShowRouteTable'
-        xpath_rt = './/ShowRoute'
+        xpath_rt = '//ShowRoute'
         xpath_pth = './/ShowRoutePath'
-        for tree in self.output_etree:
-            for table in tree.xpath(xpath_tbl):
-                tbl_name = table.find('routing_table_name').text
-                prefix_count = table.find('prefixes').text
-                tot_path_count = table.find('paths').text
-                pri_path_count = table.find('primary_paths').text
-                sec_path_count = table.find('secondary_paths').text
-                ifs_path_count = table.find('infeasible_paths').text
+        # in stream mode a table is seen after its routes, so the table
+        # header is printed on whichever of them comes first
+        for element in self.select(xpath_tbl + '|' + xpath_rt, 'ShowRoute'):
+            if element.tag == 'ShowRouteTable':
+                table = element
+            else:
+                table = next(element.iterancestors('ShowRouteTable'), None)
 
+            if table is not None:
+                tbl_name = table.findtext('routing_table_name')
                 if not(tbl_name in printedTbl):
                     print  ("\n%s: %s destinations, %s routes "
                             "(%s primary, %s secondary, %s infeasible)"
-                            % (tbl_name, prefix_count, tot_path_count,
-                               pri_path_count, sec_path_count,
-                               ifs_path_count))
+                            % (tbl_name, table.findtext('prefixes'),
+                               table.findtext('paths'),
+                               table.findtext('primary_paths'),
+                               table.findtext('secondary_paths'),
+                               table.findtext('infeasible_paths')))
                     printedTbl[tbl_name] = True
 
-
-                # start processing each route
-                for route in table.xpath(xpath_rt):
-                    paths = route.xpath(xpath_pth)
-                    if not (len(paths)):
-                        continue
-                    prefix = route.find("prefix").text
-                    prefix_modified = route.find("last_modified").text
-                    t1 = datetime.strptime(prefix_modified,
-                                           '%Y-%b-%d %H:%M:%S.%f')
-                    prefix_age = str(now - t1).replace(',', '')
-
-                    if (last and (now - t1).total_seconds() > last):
-                        for path in paths:
-                            path_modified = path.find("last_modified").text
-                            t1 = datetime.strptime(path_modified,
-                                                   '%Y-%b-%d %H:%M:%S.%f')
-                            path_age = str(now - t1).replace(',', '')
-                            if not ((now - t1).total_seconds() > last) :
-                                print ("\n%s, age: %s, last_modified: %s" %
-                                        (prefix, prefix_age, prefix_modified))
-                                print Introspect.pathToStr(indent, path, mode)
-                    else:
+            if element.tag != 'ShowRoute':
+                continue
+
+            # start processing each route
+            route = element
+            paths = route.xpath(xpath_pth)
+            if not (len(paths)):
+                continue
+            prefix = route.find("prefix").text
+            prefix_modified = route.find("last_modified").text
+            t1 = timestampUsec(prefix_modified)
+            prefix_age = ageStr(now, t1)
+
+            if (last_usec and now - t1 > last_usec):
+                # old route: select its recent paths on their timestamps
+                # alone, only those are formatted
+                stamps = [timestampUsec(path.findtext("last_modified"))
+                          for path in paths]
+                for path, t1 in zip(paths, stamps):
+                    if now - t1 <= last_usec:
                         print ("\n%s, age: %s, last_modified: %s" %
                                 (prefix, prefix_age, prefix_modified))
-                        for path in paths:
-                            print Introspect.pathToStr(indent, path, mode)
+                        print Introspect.pathToStr(indent, path, mode, now)
+            else:
+                print ("\n%s, age: %s, last_modified: %s" %
+                        (prefix, prefix_age, prefix_modified))
+                for path in paths:
+                    print Introspect.pathToStr(indent, path, mode, now)
 
+    @timed
     def showSCRoute(self, xpathExpr):
 
         # fields = ['src_virtual_network',
@@ -449,50 +2111,50 @@ class Introspect:
                   'more_specifics',
                   'ext_connecting_rt']
 
-        tbl = PrettyTable(fields)
+        tbl = prettytable.PrettyTable(fields)
         tbl.align = 'l'
 
         # start building the table
-        for tree in self.output_etree:
-            for sc in tree.xpath(xpathExpr):
-                row = []
-                for field in fields[0:2]:
-                    f = sc.find(field)
-                    if f is not None:
-                        if f.text:
-                            row.append(f.text)
-                        elif list(f):
-                            row.append(Introspect.elementToStr('', f).rstrip())
-                        else:
-                            row.append("n/a")
+        for sc in self.select(xpathExpr):
+            row = []
+            for field in fields[0:2]:
+                f = sc.find(field)
+                if f is not None:
+                    if f.text:
+                        row.append(f.text)
+                    elif list(f):
+                        row.append(Introspect.elementToStr('', f).rstrip())
                     else:
-                        row.append("non-exist")
-
-                sc_xpath = ('./connected_route/ConnectedRouteInfo'
-                            '/service_chain_addr')
-                service_chain_addr = sc.xpath(sc_xpath)[0]
-                row.append(Introspect.elementToStr('', service_chain_addr).rstrip())
-
-                specifics = ''
-                spec_xpath = './more_specifics/list/PrefixToRouteListInfo'
-                PrefixToRouteListInfo = sc.xpath(spec_xpath)
-                for p in PrefixToRouteListInfo:
-                    specifics += ("prefix: %s, aggregate: %s\n" %
-                                (p.find('prefix').text,
-                                 p.find('aggregate').text))
-                row.append(specifics.rstrip())
-
-                ext_rt = ''
-                ext_xpath = './ext_connecting_rt_info_list//ext_rt_prefix'
-                ext_rt_prefix_list = sc.xpath(ext_xpath)
-                for p in ext_rt_prefix_list:
-                    ext_rt += p.text + "\n"
-                row.append(ext_rt.rstrip())
-
-                tbl.add_row(row)
+                        row.append("n/a")
+                else:
+                    row.append("non-exist")
+
+            sc_xpath = ('./connected_route/ConnectedRouteInfo'
+                        '/service_chain_addr')
+            service_chain_addr = sc.xpath(sc_xpath)[0]
+            row.append(Introspect.elementToStr('', service_chain_addr).rstrip())
+
+            specifics = ''
+            spec_xpath = './more_specifics/list/PrefixToRouteListInfo'
+            PrefixToRouteListInfo = sc.xpath(spec_xpath)
+            for p in PrefixToRouteListInfo:
+                specifics += ("prefix: %s, aggregate: %s\n" %
+                            (p.find('prefix').text,
+                             p.find('aggregate').text))
+            row.append(specifics.rstrip())
+
+            ext_rt = ''
+            ext_xpath = './ext_connecting_rt_info_list//ext_rt_prefix'
+            ext_rt_prefix_list = sc.xpath(ext_xpath)
+            for p in ext_rt_prefix_list:
+                ext_rt += p.text + "\n"
+            row.append(ext_rt.rstrip())
+
+            tbl.add_row(row)
 
         print tbl
 
+    @timed
     def showSCRouteDetail(self, xpathExpr):
 
         indent = ' ' * 4
@@ -500,52 +2162,183 @@ class Introspect:
         fields = ['src_virtual_network', 'dest_virtual_network',
                   'service_instance', 'src_rt_instance',
                   'dest_rt_instance', 'state']
-        for tree in self.output_etree:
-
-            for sc in tree.xpath(xpathExpr):
-
-                for field in fields:
-                    print "%s: %s" % (field, sc.find(field).text)
-
-                print "connectedRouteInfo:"
-                sc_xpath = ('./connected_route/ConnectedRouteInfo'
-                            '/service_chain_addr')
-                print ("%sservice_chain_addr: %s" %
-                       (indent, sc.xpath(sc_xpath)[0].text))
-                for route in sc.xpath('./connected_route//ShowRoute'):
-                    print Introspect.routeToStr(indent, route, 'detail')
-
-                print "more_specifics:"
-                specifics = ''
-                spec_xpath = './more_specifics/list/PrefixToRouteListInfo'
-                PrefixToRouteListInfo = sc.xpath(spec_xpath)
-                for p in PrefixToRouteListInfo:
-                    specifics += ("%sprefix: %s, aggregate: %s\n" %
-                                  (indent, p.find('prefix').text,
-                                   p.find('aggregate').text))
-                print specifics.rstrip()
-
-                print "ext_connecting_rt_info_list:"
-                ext_xpath = './/ExtConnectRouteInfo/ext_rt_svc_rt/ShowRoute'
-                for route in sc.xpath(ext_xpath):
-                    print Introspect.routeToStr(indent, route, 'detail')
-
-                print ("aggregate_enable:%s\n" %
-                       (sc.find("aggregate_enable").text))
+        for sc in self.select(xpathExpr):
 
+            for field in fields:
+                print "%s: %s" % (field, sc.find(field).text)
+
+            print "connectedRouteInfo:"
+            sc_xpath = ('./connected_route/ConnectedRouteInfo'
+                        '/service_chain_addr')
+            print ("%sservice_chain_addr: %s" %
+                   (indent, sc.xpath(sc_xpath)[0].text))
+            for route in sc.xpath('./connected_route//ShowRoute'):
+                print Introspect.routeToStr(indent, route, 'detail')
+
+            print "more_specifics:"
+            specifics = ''
+            spec_xpath = './more_specifics/list/PrefixToRouteListInfo'
+            PrefixToRouteListInfo = sc.xpath(spec_xpath)
+            for p in PrefixToRouteListInfo:
+                specifics += ("%sprefix: %s, aggregate: %s\n" %
+                              (indent, p.find('prefix').text,
+                               p.find('aggregate').text))
+            print specifics.rstrip()
+
+            print "ext_connecting_rt_info_list:"
+            ext_xpath = './/ExtConnectRouteInfo/ext_rt_svc_rt/ShowRoute'
+            for route in sc.xpath(ext_xpath):
+                print Introspect.routeToStr(indent, route, 'detail')
+
+            print ("aggregate_enable:%s\n" %
+                   (sc.find("aggregate_enable").text))
+
+    @timed
     def showStaticRoute(self, xpathExpr, format, max_width, columns):
         if not columns:
             columns = []
         if not max_width:
             max_width = Default_Max_Width
-        for tree in self.output_etree:
-            for entry in tree.xpath(xpathExpr):
-                if format == 'table':
-                    print 'ri_name: %s' % (entry.find('ri_name').text)
-                    Introspect.dumpTbl(entry.xpath("//StaticRouteInfo"),
-                                       max_width, columns)
-                else:
-                    print Introspect.elementToStr('', entry)
+        for entry in self.select(xpathExpr):
+            if format == 'table':
+                print 'ri_name: %s' % (entry.find('ri_name').text)
+                Introspect.dumpTbl(entry.xpath("//StaticRouteInfo"),
+                                   max_width, columns)
+            else:
+                print Introspect.elementToStr('', entry)
+
+class MultiIntrospect(object):
+    """ same interface as Introspect, but every request goes to a list of
+        hosts at once on a bounded worker pool. Tables are merged into one
+        with a leading node column; hosts which fail are reported and
+        left out instead of aborting the run """
+
+    def __init__(self, hosts, port, filename, workers=Default_Workers):
+        self.nodes = [Introspect(host, port, filename) for host in hosts]
+        self.workers = workers
+        self.failed = {}
+
+    def get(self, path):
+        self.path = path
+        self.failed = {}
+        if stream or limit is not None:
+            # each host is streamed in turn by select(), rather than all of
+            # them held at once. Failures are reported there
+            for node in self.nodes:
+                node.get(path)
+            return
+        for node, error in fetchAll([(node, path) for node in self.nodes],
+                                    self.workers):
+            if error is not None:
+                self.failed[node.host] = error
+                reportError(node.host, error)
+
+    def alive(self):
+        return [node for node in self.nodes if node.host not in self.failed]
+
+    def prefetch(self, paths):
+        """ with --async, all paths of all hosts at once """
+        if not asynchronous or self.nodes[0].filename or limit is not None:
+            return
+        engine = AsyncEngine(self.workers)
+        for chain in engine.run([(node, path) for node in self.nodes
+                                 for path in paths]):
+            if chain.error is None:
+                chain.ist.prefetched[chain.path] = chain.pages
+
+    def nodeSelect(self, node, xpathExpr):
+        """ select() of one host. Pages fetched only now (with --limit)
+            may fail, the host is then reported and left out """
+        try:
+            for element in node.select(xpathExpr):
+                yield element
+        except IntrospectError as e:
+            self.failed[node.host] = e
+            reportError(node.host, e)
+
+    def select(self, xpathExpr):
+        for node in self.alive():
+            for element in self.nodeSelect(node, xpathExpr):
+                yield element
+
+    def tblRecords(self, xpathExpr):
+        for node in self.alive():
+            for element in self.nodeSelect(node, xpathExpr):
+                yield [node.host], element
+
+    tblPrefix = ['node']
+
+    def traceEntries(self, xpathExpr, since=None, until=None):
+        """ entries of all hosts on one timeline, the host is inserted
+            after the timestamp """
+        streams = [(node.host, self.nodeTrace(node, xpathExpr, since, until))
+                   for node in self.alive()]
+        for usec, host, text in mergeTraces(streams):
+            stamp, _, rest = text.partition(' ')
+            yield usec, '%s %s %s' % (stamp, host, rest)
+
+    def nodeTrace(self, node, xpathExpr, since, until):
+        """ traceEntries() of one host, see nodeSelect """
+        try:
+            for entry in node.traceEntries(xpathExpr, since, until):
+                yield entry
+        except IntrospectError as e:
+            self.failed[node.host] = e
+            reportError(node.host, e)
+
+    @timed
+    def printTraceText(self, xpathExpr, since=None, until=None):
+        """ trace buffers of all hosts on one timeline """
+        out = TextSink()
+        for usec, text in self.traceEntries(xpathExpr, since, until):
+            out.write('\n' + Introspect.traceToStr(usec, text) + '\n')
+        out.close()
+
+    @timed
+    def printRecords(self, xpathExpr, format, *args):
+        """ records of all hosts with a leading node field """
+        Introspect.dumpRecords(self.tblRecords(xpathExpr), self.tblPrefix,
+                               format, args)
+
+    @timed
+    def printStaticRoutes(self, xpathExpr, format, columns):
+        """ static routes of all hosts with a leading node field """
+        Introspect.dumpRecords(
+            Introspect.staticRouteRecords(self.tblRecords(xpathExpr)),
+            self.tblPrefix + ['ri_name'], format, columns)
+
+    @timed
+    def printTbl(self, xpathExpr, max_width=Default_Max_Width, *args):
+        """ print one table for all hosts with a leading node column """
+        tbl = None
+        for node in self.alive():
+            for entry in self.nodeSelect(node, xpathExpr):
+                if tbl is None:
+                    fields = Introspect.tblFields(entry, args)
+                    tbl = Introspect.newTbl(['node'] + fields, max_width)
+                tbl.add_row([node.host] + Introspect.tblRow(entry, fields))
+
+        if tbl is not None:
+            Introspect.closeTbl(tbl)
+
+    def __getattr__(self, name):
+        """ other printers run per host under a host header. The header
+            goes to stderr when the output is jsonl/csv/tsv, so that it
+            stays parseable """
+        method = getattr(Introspect, name)
+        def run(*args, **kwargs):
+            machine = any(arg in RecordWriter.formats for arg in
+                          args + tuple(kwargs.values())
+                          if isinstance(arg, basestring))
+            out = sys.stderr if machine else sys.stdout
+            for node in self.alive():
+                out.write("Introspect Host: %s\n" % node.host)
+                try:
+                    method(node, *args, **kwargs)
+                except IntrospectError as e:
+                    self.failed[node.host] = e
+                    reportError(node.host, e)
+        return run
 
 class CLI_basic(object):
     try:
@@ -582,25 +2375,37 @@ class CLI_basic(object):
 
     common_parser = argparse.ArgumentParser(add_help=False)
     common_parser.add_argument('-f', '--format',
-                               choices=['table', 'text'],
+                               choices=['table', 'text', 'jsonl', 'csv',
+                                        'tsv'],
                                default = 'table',
                                help='Output format.')
     common_parser.add_argument('-c', '--columns', nargs= '*',
                                help='Column(s) to include')
     common_parser.add_argument('--max_width', type=int,
                                help="Max width per column")
+    common_parser.add_argument('--watch', type=float,
+                               metavar='INTERVAL',
+                               help="Poll every INTERVAL seconds and print "
+                                    "only records added(+), removed(-) or "
+                                    "changed(~) since the last poll")
+
+    @classmethod
+    def defaultPort(cls, role):
+        try:
+            return cls.IntrospectPortMap[ServiceMap[role]]
+        except:
+            return cls.IntrospectPortMap[ServiceMap[role] + ':0']
 
     def __init__(self, parser, host, port, filename):
 
-        host = host or '127.0.0.1'
         if port is None:
-            cli_type = type(self).__name__[4:]
-            try:
-                port = self.IntrospectPortMap[ServiceMap[cli_type]]
-            except:
-                port = self.IntrospectPortMap[ServiceMap[cli_type] + ':0']
+            port = self.defaultPort(type(self).__name__[4:])
 
-        self.IST = Introspect(host, port, filename)
+        if isinstance(host, list):
+            self.IST = MultiIntrospect(host, port, filename, workers)
+        else:
+            host = host or '127.0.0.1'
+            self.IST = Introspect(host, port, filename)
 
         self.subparser = parser.add_subparsers()
 
@@ -615,6 +2420,20 @@ class CLI_basic(object):
 
         subp = self.subparser.add_parser('trace', help='Sandesh trace buffer')
         subp.add_argument('name', nargs='?', help='Trace buffer name')
+        subp.add_argument('--follow', action="store_true",
+                          help='Keep polling the buffer and print new '
+                               'entries only')
+        subp.add_argument('--interval', type=float, default=1.0,
+                          help='Seconds between polls with --follow. '
+                               'Default: 1')
+        subp.add_argument('--since', type=valid_time,
+                          help='Only entries from this time on: '
+                               '"YYYY-MM-DD HH:MM:SS[.ffffff]", '
+                               '"HH:MM:SS" (today) or a period ago '
+                               '(e.g. 10s, 5m, 2h)')
+        subp.add_argument('--until', type=valid_time,
+                          help='Only entries up to this time, same formats '
+                               'as --since')
         subp.set_defaults(func=self.SnhTrace)
 
         subp = self.subparser.add_parser('uve',
@@ -624,8 +2443,15 @@ class CLI_basic(object):
         subp.set_defaults(func=self.SnhUve)
 
     def output_formatters(self, args, xpath, default_columns=[]):
-        if args.format == 'text':
+        if getattr(args, 'watch', None):
+            watchOutput(self.IST, xpath, args.watch, args.format,
+                        args.max_width or Default_Max_Width,
+                        args.columns or default_columns)
+        elif args.format == 'text':
             self.IST.printText(xpath)
+        elif args.format in RecordWriter.formats:
+            self.IST.printRecords(xpath, args.format,
+                                  *(args.columns or default_columns))
         else:
             max_width = args.max_width or Default_Max_Width
             if args.columns:
@@ -633,6 +2459,15 @@ class CLI_basic(object):
             else:
                 self.IST.printTbl(xpath, max_width, *default_columns)
 
+    @staticmethod
+    def noWatch(args):
+        """ for commands taking the common options but printing their
+            output once """
+        if getattr(args, 'watch', None):
+            sys.stderr.write("ist: error: argument --watch: not supported "
+                             "by this command\n")
+            sys.exit(2)
+
     def SnhNodeStatus(self, args):
         self.IST.get('Snh_SandeshUVECacheReq?tname=NodeStatus')
         if args.raw:
@@ -655,7 +2490,11 @@ class CLI_basic(object):
             #self.IST.printText('//*[not(*)]')
         else:
             self.IST.get('Snh_SandeshTraceRequest?x=' + str(args.name))
-            self.IST.printTraceText('//element')
+            if args.follow:
+                followTrace(self.IST, '//element', args.interval,
+                            args.since, args.until)
+            else:
+                self.IST.printTraceText('//element', args.since, args.until)
             #self.IST.printText('//element')
             #self.IST.printText('//*[not(*)]')
 
@@ -867,6 +2706,29 @@ class CLI_ctr(CLI_basic):
                           help='Shows less specific routes')
         subp.set_defaults(func=self.SnhShowRoute)
 
+        subp = rp.add_parser('check', help='Compare the routes of a '
+                             'routing instance with vrouter agents ones')
+        subp.add_argument('vrf', help='Routing instance fqn, e.g. '
+                                      'default-domain:admin:vn1:vn1')
+        subp.add_argument('-a', '--agents', default='',
+                          help='Comma separated vrouter agent hosts')
+        subp.add_argument('--agents-file',
+                          help='File listing vrouter agent hosts, one per '
+                               'line')
+        subp.add_argument('--agent-port', type=int,
+                          default=self.defaultPort('vr'),
+                          help="Agent introspect port(default=%(default)s)")
+        subp.add_argument('--family', default='inet',
+                          choices=['inet', 'inet6'],
+                          help="Route family(default='%(default)s')")
+        subp.add_argument('-f', '--format', default='table',
+                          choices=['table', 'jsonl', 'csv', 'tsv'],
+                          help='Output format.')
+        subp.add_argument('-d', '--detail', action="store_true",
+                          help='List paths missing (-) or stale (+) on '
+                               'agents')
+        subp.set_defaults(func=self.SnhRouteCheck)
+
         subp = rp.add_parser('static', parents = [self.common_parser],
                              help='Show static routes')
         subp.add_argument('search', nargs='?', default='',type=str,
@@ -1027,11 +2889,15 @@ class CLI_ctr(CLI_basic):
         subp.set_defaults(func=self.SnhShowRtGroupReq)
 
     def SnhShowStaticRoute(self, args):
+        self.noWatch(args)
         path = 'Snh_ShowStaticRouteReq?search_string=%s' % (args.search)
         xpath = '//StaticRouteEntriesInfo'
         self.IST.get(path)
-        self.IST.showStaticRoute(xpath, args.format, args.max_width,
-                                 args.columns)
+        if args.format in RecordWriter.formats:
+            self.IST.printStaticRoutes(xpath, args.format, args.columns or [])
+        else:
+            self.IST.showStaticRoute(xpath, args.format, args.max_width,
+                                     args.columns)
 
     def SnhShowRouteAggregate(self, args):
         path = 'Snh_ShowRouteAggregateReq?search_string=%s' % (args.search)
@@ -1120,7 +2986,8 @@ class CLI_ctr(CLI_basic):
             self.output_formatters(args, xpath, default_columns)
 
     def IFMapPeerServerInfoReq(self,args):
-        args.format = 'text'
+        if args.format == 'table':
+            args.format = 'text'
         path = 'Snh_IFMapPeerServerInfoReq?'
         if args.type == 'all':
             xpath = '//IFMapPeerServerInfoResp'
@@ -1152,11 +3019,13 @@ class CLI_ctr(CLI_basic):
 
     def SnhIFMapNodeShow(self, args):
         if args.fqn:
-            args.format = 'text'
+            if args.format == 'table':
+                args.format = 'text'
             path = 'Snh_IFMapNodeShowReq?fq_node_name=%s' % (args.fqn)
             xpath = '//IFMapNodeShowInfo'
         else:
-            args.format = 'text'
+            if args.format == 'table':
+                args.format = 'text'
             path = 'Snh_IFMapTableShowReq?search_string=%s' % (args.search)
             xpath = '//node_name'
 
@@ -1167,7 +3036,8 @@ class CLI_ctr(CLI_basic):
         path = 'Snh_IFMapXmppShowReq?'
         if args.type == 'stats':
             xpath = '//IFMapChannelManagerStats'
-            args.format = 'text'
+            if args.format == 'table':
+                args.format = 'text'
         else:
             xpath = '//IFMapXmppChannelMapEntry'
         self.IST.get(path)
@@ -1211,6 +3081,7 @@ class CLI_ctr(CLI_basic):
             self.output_formatters(args, p, default_columns)
 
     def SnhXmppMsg(self, args):
+        self.noWatch(args)
         self.IST.get('Snh_SandeshTraceRequest?x=XmppMessageTrace')
         self.IST.printText('//element')
 
@@ -1310,6 +3181,26 @@ class CLI_ctr(CLI_basic):
         # to showrouter method
         self.IST.showRoute_CTR(args.last, mode)
 
+    def SnhRouteCheck(self, args):
+        agents = [a.strip() for a in args.agents.split(',') if a.strip()]
+        if args.agents_file:
+            try:
+                with open(args.agents_file) as f:
+                    for line in f:
+                        line = line.split('#')[0].strip()
+                        if line:
+                            agents.append(line)
+            except IOError as e:
+                print "Failed to read %s: %s" % (args.agents_file,
+                                                 e.strerror)
+                sys.exit(1)
+        if not agents:
+            print "No agents given, use --agents or --agents-file"
+            sys.exit(1)
+        controls = getattr(self.IST, 'nodes', [self.IST])
+        routeConsistency(controls, args.vrf, args.family, agents,
+                         args.agent_port, workers, args.format, args.detail)
+
 class CLI_vr(CLI_basic):
     def __init__(self, parser, host, port, filename):
         CLI_basic.__init__(self, parser, host, port, filename)
@@ -1360,6 +3251,9 @@ class CLI_vr(CLI_basic):
                           help='Display detailed output')
         subp.add_argument('-r', '--raw', action="store_true",
                           help='Display raw output in plain text')
+        subp.add_argument('--addresses-file', metavar='FILE',
+                          help='Resolve every address listed in FILE '
+                               '(- for stdin), one line per address')
         subp.set_defaults(func=self.SnhRoute)
 
         ## show security groups
@@ -1466,6 +3360,20 @@ class CLI_vr(CLI_basic):
                           help='NH policy')
         subp.set_defaults(func=self.SnhNhList)
 
+        ## show flows
+        subp = self.subparser.add_parser('flow', help='Flow table summary: '
+                                         'top talkers, flows and drop '
+                                         'reasons')
+        subp.add_argument('-n', '--top', type=int, default=10,
+                          help='Rows per summary(default=%(default)s)')
+        subp.add_argument('-b', '--by', default='bytes',
+                          choices=['bytes', 'packets', 'flows'],
+                          help="Rank by(default='%(default)s')")
+        subp.add_argument('-f', '--format', default='table',
+                          choices=['table', 'jsonl'],
+                          help='Output format.')
+        subp.set_defaults(func=self.SnhFlow)
+
         ## show vm info
         subp = self.subparser.add_parser('vm',
                                          parents = [self.common_parser],
@@ -1599,6 +3507,10 @@ class CLI_vr(CLI_basic):
         self.IST.get(path)
         self.output_formatters(args, xpath, default_columns)
 
+    def SnhFlow(self, args):
+        flowSummary(getattr(self.IST, 'nodes', [self.IST]), args.top,
+                    args.by, args.format)
+
     def SnhServiceInstance(self, args):
         uuid = args.uuid or ''
         path = 'Snh_ServiceInstanceReq?uuid=%s' % (uuid)
@@ -1674,6 +3586,21 @@ class CLI_vr(CLI_basic):
 
     def SnhRoute(self, args):
 
+        if args.addresses_file:
+            try:
+                if args.addresses_file == '-':
+                    lines = sys.stdin.readlines()
+                else:
+                    with open(args.addresses_file) as f:
+                        lines = f.readlines()
+            except IOError as e:
+                print "Failed to read %s: %s" % (args.addresses_file,
+                                                 e.strerror)
+                sys.exit(1)
+            addresses = [line.split('#')[0].strip() for line in lines]
+            self.IST.resolveAddresses([a for a in addresses if a], args.vrf)
+            return
+
         if args.family =='':
             if args.address == '' or is_ipv4(args.address):
                 args.family = 'inet'
@@ -1734,7 +3661,10 @@ class CLI_vr(CLI_basic):
         if args.type == 'all':
             # As tables are too big, force output in text format
             # when type is ifmap or all
-            args.format = 'text'
+            if args.format == 'table':
+                args.format = 'text'
+            self.IST.prefetch(['Snh_AgentStatsReq',
+                               'Snh_ShowIFMapAgentStatsReq'])
             self.IST.get('Snh_AgentStatsReq')
             xpath = '|'.join(StatsMap.values())
             self.output_formatters(args, xpath)
@@ -1781,7 +3711,8 @@ class CLI_vr(CLI_basic):
             xpath = ("//*[self::PktStats or self::DhcpStats "
                      "or self::ArpStats or self::DnsStats "
                      "or self::IcmpStats or self::MetadataResponse]")
-            args.format = "text"
+            if args.format == 'table':
+                args.format = 'text'
 
         self.IST.get(path)
         self.output_formatters(args, xpath)
@@ -1807,7 +3738,8 @@ class CLI_vr(CLI_basic):
                 (args.table, args.node, args.link_type, args.link_node))
 
         self.IST.get(path)
-        args.format = 'text'
+        if args.format == 'table':
+            args.format = 'text'
         self.output_formatters(args, "//element")
 
 class CLI_collector(CLI_basic):
@@ -1870,6 +3802,921 @@ def valid_period(s):
         }
         return int(s[0:-1]) * mapping.get(s[-1], 0)
 
+def valid_time(s):
+    """ --since/--until: local time, or a period before now, in usec """
+    for fmt in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S',
+                '%Y-%m-%d', '%H:%M:%S.%f', '%H:%M:%S'):
+        try:
+            dt = datetime.strptime(s, fmt)
+        except ValueError:
+            continue
+        if not fmt.startswith('%Y'):
+            dt = datetime.combine(datetime.now().date(), dt.time())
+        return int(time.mktime(dt.timetuple())) * 1000000 + dt.microsecond
+    try:
+        return int((time.time() - valid_period(s)) * 1000000)
+    except (argparse.ArgumentTypeError, ValueError, IndexError):
+        raise argparse.ArgumentTypeError(
+            'invalid time %r, use "YYYY-MM-DD HH:MM:SS[.ffffff]", '
+            '"HH:MM:SS" or a period such as 10s, 5m, 2h' % s)
+
+def positive_int(s):
+    try:
+        value = int(s)
+    except ValueError:
+        value = 0
+    if value < 1:
+        raise argparse.ArgumentTypeError(
+            "invalid positive int value: '%s'" % s)
+    return value
+
+def optionValue(argv, option, type=str):
+    """ value of a global option given as '--opt value' or '--opt=value',
+        before or after the command as role parsers don't know it. None
+        when not given, an invalid value ends ist as argparse would """
+    for i, arg in enumerate(argv):
+        if arg == option:
+            value = argv[i + 1] if i + 1 < len(argv) else None
+        elif arg.startswith(option + '='):
+            value = arg[len(option) + 1:]
+        else:
+            continue
+        if value is None:
+            break
+        try:
+            return type(value)
+        except (argparse.ArgumentTypeError, ValueError) as e:
+            sys.stderr.write("ist: error: argument %s: %s\n" % (option, e))
+            sys.exit(2)
+    return None
+
+Epoch = datetime(1970, 1, 1)
+Timestamp_Days = {}
+
+def datetimeUsec(dt):
+    """ microseconds since epoch of naive UTC datetime dt """
+    delta = dt - Epoch
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def timestampUsec(text):
+    """ microseconds since epoch of introspect time text, as parsed by
+        strptime(text, '%Y-%b-%d %H:%M:%S.%f'). Routes share a handful of
+        dates, so only the date part goes through strptime, once """
+    try:
+        day, clock = text.split(' ', 1)
+        hour, minute, second = clock.split(':')
+        second, fraction = second.split('.')
+        if len(fraction) > 6:
+            raise ValueError(text)
+        usec = ((int(hour) * 60 + int(minute)) * 60 + int(second)) * \
+               1000000 + int(fraction.ljust(6, '0'))
+    except ValueError:
+        return datetimeUsec(datetime.strptime(text, '%Y-%b-%d %H:%M:%S.%f'))
+    if day not in Timestamp_Days:
+        Timestamp_Days[day] = datetimeUsec(datetime.strptime(day, '%Y-%b-%d'))
+    return Timestamp_Days[day] + usec
+
+def ageStr(now, usec):
+    """ str(now - then) of two timestampUsec values, without commas """
+    return str(timedelta(microseconds=now - usec)).replace(',', '')
+
+def watchKey(entry, counts):
+    """ natural identifier of a record, repeated ids are numbered """
+    field = Watch_Keys.get(entry.tag)
+    if field is None:
+        for field in Watch_Default_Keys:
+            if entry.find(field) is not None:
+                break
+        else:
+            field = None
+    if field is None:
+        key = (entry.tag, etree.tostring(entry))
+    else:
+        key = (entry.tag, entry.findtext(field))
+    n = counts[key] = counts.get(key, 0) + 1
+    return key + (n,)
+
+def watchOutput(ist, xpathExpr, interval, format, max_width, columns):
+    """ re-poll the last request of ist every interval seconds. The first
+        poll is printed in full, then only records whose natural key
+        (Watch_Keys) appeared, disappeared or whose printed fields changed.
+        Re-polls go to the host, past --cache """
+    global cache
+    path = ist.path
+    fields = None
+    records = format in RecordWriter.formats
+    out = None
+    last = None
+    last_order = []
+    try:
+        while True:
+            start = time.time()
+            if last is not None:
+                cache = None
+                ist.get(path)
+            current = {}
+            order = []
+            counts = {}
+            for prefix, entry in ist.tblRecords(xpathExpr):
+                if format == 'text':
+                    value = Introspect.elementToStr('', entry).rstrip()
+                elif records:
+                    if out is None:
+                        if len(columns) or format != 'jsonl':
+                            fields = Introspect.tblFields(entry, columns)
+                        out = RecordWriter(format, ['change'] + ist.tblPrefix
+                                                   + (fields or []))
+                    value = Introspect.recordToObj(entry, fields,
+                                                   zip(ist.tblPrefix, prefix))
+                else:
+                    if fields is None:
+                        fields = Introspect.tblFields(entry, columns)
+                    value = tuple(prefix + Introspect.tblRow(entry, fields))
+                key = tuple(prefix) + watchKey(entry, counts)
+                current[key] = value
+                order.append(key)
+
+            if last is None:
+                changes = [(' ', current[key]) for key in order]
+            else:
+                changes = []
+                for key in order:
+                    if key not in last:
+                        changes.append(('+', current[key]))
+                    elif last[key] != current[key]:
+                        changes.append(('~', current[key]))
+                for key in last_order:
+                    if key not in current:
+                        changes.append(('-', last[key]))
+            last = current
+            last_order = order
+
+            if changes:
+                if records:
+                    for change, value in changes:
+                        record = OrderedDict([('change', change.strip())])
+                        record.update(value)
+                        out.write(record)
+                elif format == 'text':
+                    print datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                    for change, value in changes:
+                        print change + ' ' + value.replace('\n', '\n  ')
+                else:
+                    tbl = prettytable.PrettyTable([''] + ist.tblPrefix +
+                                                  fields)
+                    tbl.align = 'l'
+                    tbl.max_width = max_width
+                    for change, value in changes:
+                        tbl.add_row([change] + list(value))
+                    print datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                    print tbl
+                sys.stdout.flush()
+
+            time.sleep(max(0, interval - (time.time() - start)))
+    except KeyboardInterrupt:
+        pass
+
+def fetchAll(jobs, limit):
+    """ get() each (introspect, path) of jobs concurrently, at most limit
+        at a time: on one event loop with --async, else on a thread pool.
+        Returns (introspect, error or None) pairs """
+    def fetch(job):
+        node, path = job
+        try:
+            node.getAll(path)
+        except Exception as e:
+            return node, e
+        return node, None
+
+    if not jobs:
+        return []
+    if asynchronous and not jobs[0][0].filename:
+        results = []
+        waiting = []
+        for node, path in jobs:
+            if path in node.prefetched:
+                node.get(path)
+                results.append((node, None))
+            else:
+                waiting.append((node, path))
+        for chain in AsyncEngine(limit).run(waiting):
+            if chain.error is None:
+                chain.ist.usePages(chain.path, chain.pages)
+            results.append((chain.ist, chain.error))
+        return results
+    pool = threadpool.ThreadPool(max(1, min(limit, len(jobs))))
+    try:
+        return pool.map(fetch, jobs)
+    finally:
+        pool.close()
+
+def reportError(host, error):
+    """ a failed host is reported without stopping the others, ist then
+        exits with status 1 once they are done """
+    global failures
+    failures += 1
+    if isinstance(error, IntrospectError):
+        reason = error.detail
+    else:
+        reason = str(error) or type(error).__name__
+    sys.stderr.write("ERROR: %s: %s\n" % (host, reason))
+
+def mergeTraces(streams):
+    """ k-way merge of (label, trace entries) streams, each in time order,
+        into (usec, label, text) in time order. Only the head entry of
+        each stream is held, in a heap """
+    def labelled(label, entries):
+        for usec, text in entries:
+            if usec is not None:
+                yield usec, label, text
+    return heapq.merge(*[labelled(label, entries)
+                         for label, entries in streams])
+
+def traceSpecs(specs, hosts, port, buffer):
+    """ parse ROLE[@HOST[:PORT][,HOST[:PORT]...]][/BUFFER] specs into
+        (label, host, port, buffer). Without @HOST the --host hosts are
+        used, without /BUFFER the --buffer one. Labels are role@host:port,
+        so that two services of one host stay apart """
+    parsed = []
+    for spec in specs:
+        spec, _, spec_buffer = spec.partition('/')
+        role, _, spec_hosts = spec.partition('@')
+        if role not in ServiceMap:
+            print "Invalid role in %s, one of: %s" % (
+                    spec, ', '.join(sorted(ServiceMap)))
+            sys.exit(1)
+        name = spec_buffer or buffer
+        if not name:
+            print "No trace buffer for %s, use %s/BUFFER or --buffer" % (
+                    spec, spec)
+            sys.exit(1)
+        for host in (spec_hosts.split(',') if spec_hosts else hosts):
+            host = host.strip()
+            host_port = port or CLI_basic.defaultPort(role)
+            m = re.match(r'^(.+):(\d+)$', host)
+            if m:
+                host, host_port = m.group(1), int(m.group(2))
+            parsed.append(('%s@%s:%s' % (role, host, host_port), host,
+                           host_port, name))
+    if len(set(name for _, _, _, name in parsed)) > 1:
+        parsed = [(label + '/' + name, host, host_port, name)
+                  for label, host, host_port, name in parsed]
+    return parsed
+
+def mergedTrace(args, hosts, port, filename):
+    """ ist mtrace: trace buffers of many hosts and roles on one
+        timeline """
+    sources = traceSpecs(args.source, hosts, port, args.buffer)
+    nodes = [(label, Introspect(host, host_port, filename), name)
+             for label, host, host_port, name in sources]
+    failed = set()
+    for ist, error in fetchAll([(ist, 'Snh_SandeshTraceRequest?x=' + name)
+                                for _, ist, name in nodes], workers):
+        if error is not None:
+            failed.add(ist)
+            reportError(ist.host + ':' + str(ist.port), error)
+    streams = [(label, ist.traceEntries('//element', args.since, args.until))
+               for label, ist, name in nodes if ist not in failed]
+    out = TextSink()
+    for usec, label, text in mergeTraces(streams):
+        stamp, _, rest = text.partition(' ')
+        out.write(Introspect.traceToStr(usec, stamp + ' ' + label + ' ' +
+                                        rest) + '\n')
+    out.close()
+
+Agent_Route_Reqs = {
+    'inet': 'Snh_Inet4UcRouteReq?vrf_index=%s&src_ip=&prefix_len=&stale=',
+    'inet6': 'Snh_Inet6UcRouteReq?vrf_index=%s&src_ip=&prefix_len=&stale=',
+}
+
+def normalPrefix(prefix):
+    """ one spelling per prefix, IPv6 addresses are compressed """
+    address, _, plen = prefix.partition('/')
+    if ':' in address:
+        try:
+            address = socket.inet_ntop(socket.AF_INET6, socket.inet_pton(
+                socket.AF_INET6, address))
+        except (socket.error, ValueError):
+            pass
+    return address + '/' + plen
+
+def normalLabel(label):
+    try:
+        return str(int(label))
+    except (TypeError, ValueError):
+        return label
+
+def ctrRouteTuples(ist, vrf, family):
+    """ (prefix, next hop, label, best) of each path of vrf on a control
+        node. Best paths, the ones sent to agents, are the first path of
+        a route and the others with the same local preference """
+    path = ('Snh_ShowRouteReq?routing_table=%s.%s.0&routing_instance='
+            '&prefix=&longer_match=&shorter_match=&count='
+            '&start_routing_table=&start_routing_instance=&start_prefix='
+            '&source=&protocol=&family=' % (vrf, family))
+    for route in ist.records(path, '//ShowRoute'):
+        prefix = normalPrefix(route.findtext('prefix'))
+        first = None
+        for p in compiledXPath('.//ShowRoutePath')(route):
+            preference = p.findtext('local_preference')
+            if first is None:
+                first = preference
+            yield (prefix, p.findtext('next_hop'),
+                   normalLabel(p.findtext('label')), preference == first)
+
+def agentRouteTuples(ist, vrf_index, family, address):
+    """ (prefix, set of (prefix, next hop, label)) of each route of an
+        agent VRF. Tunnel nexthops lead to their dip, composite ones to the
+        dip of each component and local ones to the agent address """
+    for route in ist.records(Agent_Route_Reqs[family] % vrf_index,
+                             '//RouteUcSandeshData'):
+        prefix = normalPrefix(route.findtext('src_ip') + '/' +
+                              route.findtext('src_plen'))
+        tuples = set()
+        for path in compiledXPath('.//PathSandeshData')(route):
+            label = normalLabel(path.findtext('label'))
+            nh = path.find('nh/NhSandeshData')
+            nh_type = nh.findtext('type') if nh is not None else None
+            if nh_type == 'tunnel':
+                tuples.add((prefix, nh.findtext('dip'), label))
+            elif nh_type == 'interface':
+                tuples.add((prefix, address, label))
+            elif nh_type == 'composite':
+                components = nh.findall('.//*[dip]')
+                for c in components:
+                    tuples.add((prefix, c.findtext('dip'),
+                                normalLabel(c.findtext('label')) or label))
+                if not components:
+                    tuples.add((prefix, address, label))
+        yield prefix, tuples
+
+def agentVrf(ist, vrf, family):
+    """ (route table index of vrf or None, vhost0 address) of an agent """
+    index = None
+    ist.get('Snh_VrfListReq?name=' + vrf)
+    for entry in ist.select('//VrfSandeshData'):
+        if entry.findtext('name') == vrf:
+            index = (family == 'inet6' and entry.findtext('uc6index') or
+                     entry.findtext('ucindex'))
+    ist.get('Snh_ItfReq?name=vhost0&type=&uuid=&vn=&mac=&ipv4_address=')
+    address = None
+    for entry in ist.select('//ItfSandeshData'):
+        if entry.findtext('name') == 'vhost0':
+            address = entry.findtext('ip_addr')
+    return index, address
+
+def routeConsistency(controls, vrf, family, agents, port, limit, format,
+                     detail):
+    """ ctr route check: the paths of vrf on the control nodes against the
+        routes of many agents, compared as sets of (prefix, next hop,
+        label) hashes. Control node paths are read first into a dict of
+        hash to best path number (-1 for the others), then agents are read
+        concurrently, each one marking the best paths it has in a
+        bytearray. Only hashes are kept, so with -d the control nodes are
+        read again for the paths some agent misses """
+    paths = {}
+    best = []
+    for ist in controls:
+        try:
+            for prefix, next_hop, label, is_best in \
+                    ctrRouteTuples(ist, vrf, family):
+                key = hash((prefix, next_hop, label))
+                if is_best and paths.get(key, -1) < 0:
+                    paths[key] = len(best)
+                    best.append(key)
+                elif key not in paths:
+                    paths[key] = -1
+        except IntrospectError as e:
+            reportError(ist.host, e)
+            controls = [c for c in controls if c is not ist]
+    if not controls:
+        sys.exit(1)
+
+    def check(host):
+        ist = Introspect(host, port, None)
+        result = OrderedDict([('agent', host), ('address', None),
+                              ('vrf_index', None), ('routes', 0),
+                              ('paths', 0), ('missing', None),
+                              ('stale', None)])
+        missing, stale = [], []
+        try:
+            index, address = agentVrf(ist, vrf, family)
+            result['address'] = address
+            if index is None:
+                return result, None, missing, stale
+            result['vrf_index'] = int(index)
+            seen = bytearray(len(best))
+            for prefix, tuples in agentRouteTuples(ist, index, family,
+                                                   address):
+                result['routes'] += 1
+                result['paths'] += len(tuples)
+                for t in tuples:
+                    i = paths.get(hash(t))
+                    if i is None:
+                        stale.append(t)
+                    elif i >= 0:
+                        seen[i] = 1
+        except Exception as e:
+            return result, e, [], []
+        result['missing'] = len(seen) - sum(seen)
+        result['stale'] = len(stale)
+        if detail:
+            missing = [best[i] for i, flag in enumerate(seen) if not flag]
+        return result, None, missing, stale
+
+    fields = ['agent', 'address', 'vrf_index', 'routes', 'paths', 'missing',
+              'stale']
+    if format in RecordWriter.formats:
+        out = RecordWriter(format, fields if not detail else
+                           ['agent', 'diff', 'prefix', 'next_hop', 'label'])
+    else:
+        print ("%s.%s.0: %d paths, %d best, on %s"
+               % (vrf, family, len(paths), len(best),
+                  ', '.join(ist.host for ist in controls)))
+        tbl = prettytable.PrettyTable(fields)
+        tbl.align = 'l'
+    missed = OrderedDict()
+    stales = OrderedDict()
+    pool = threadpool.ThreadPool(max(1, min(limit, len(agents))))
+    try:
+        for result, error, missing, stale in pool.imap(check, agents):
+            host = result['agent']
+            if error is not None:
+                reportError(host, error)
+                continue
+            for key in missing:
+                missed.setdefault(key, []).append(host)
+            for t in stale:
+                stales.setdefault(t, []).append(host)
+            if format not in RecordWriter.formats:
+                tbl.add_row(['-' if v is None else v
+                             for v in result.values()])
+            elif not detail:
+                out.write(result)
+    finally:
+        pool.close()
+
+    if format not in RecordWriter.formats:
+        print tbl
+    if not detail:
+        return
+
+    # only hashes of missing paths were kept, read them again
+    for ist in controls:
+        if not missed:
+            break
+        try:
+            for prefix, next_hop, label, is_best in \
+                    ctrRouteTuples(ist, vrf, family):
+                hosts = missed.pop(hash((prefix, next_hop, label)), None)
+                if hosts:
+                    showRouteDiff(out if format in RecordWriter.formats
+                                  else None, '-', (prefix, next_hop, label),
+                                  hosts)
+        except IntrospectError as e:
+            reportError(ist.host, e)
+    if missed:
+        sys.stderr.write("%d missing paths are gone from the control "
+                         "nodes\n" % len(missed))
+    for t, hosts in stales.iteritems():
+        showRouteDiff(out if format in RecordWriter.formats else None, '+',
+                      t, hosts)
+
+def showRouteDiff(out, diff, path, hosts):
+    """ a path missing (-) or stale (+) on hosts """
+    prefix, next_hop, label = path
+    if out is None:
+        print "%s %s via %s label %s: %s" % (diff, prefix, next_hop, label,
+                                             ' '.join(hosts))
+        return
+    for host in hosts:
+        out.write(OrderedDict([('agent', host), ('diff', diff),
+                               ('prefix', prefix), ('next_hop', next_hop),
+                               ('label', label)]))
+
+class SpaceSaving(object):
+    """ approximate top-k of a weighted stream with a bounded number of
+        counters (space-saving). A key not counted yet takes over the
+        smallest counter and inherits its weight as error, so heavy keys
+        stay and their weight is overestimated by at most that error.
+        A heap of (weight, key), with stale entries skipped on pop, finds
+        the smallest counter """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counters = {}
+        self.heap = []
+
+    def add(self, key, weight):
+        counter = self.counters.get(key)
+        if counter is None:
+            error = self.evict() if len(self.counters) >= self.capacity \
+                    else 0
+            counter = self.counters[key] = [error, error]
+        counter[0] += weight
+        heapq.heappush(self.heap, (counter[0], key))
+        if len(self.heap) > 4 * self.capacity:
+            self.heap = [(c[0], k) for k, c in self.counters.iteritems()]
+            heapq.heapify(self.heap)
+
+    def evict(self):
+        while True:
+            weight, key = heapq.heappop(self.heap)
+            counter = self.counters.get(key)
+            if counter is not None and counter[0] == weight:
+                del self.counters[key]
+                return weight
+
+    def top(self, n):
+        """ n heaviest (key, weight, error) """
+        return [(k, c[0], c[1]) for k, c in
+                heapq.nlargest(n, self.counters.iteritems(),
+                               key=lambda item: item[1][0])]
+
+Flow_Start_Key = '0-0-0-0-0-0.0.0.0-0.0.0.0'
+
+def flowRecords(ist):
+    """ SandeshFlowData of an agent, streamed set by set: each response
+        ends with the flow_key the next set starts from. The last set
+        gives the start key back, or no key, or no flows """
+    path = 'Snh_FetchAllFlowRecords'
+    seen = set()
+    while path:
+        key = None
+        flows = 0
+        for element in ist.records(path, '//SandeshFlowData|//flow_key'):
+            if element.tag == 'flow_key':
+                key = element.text
+            else:
+                flows += 1
+                yield element
+        if not key or key == Flow_Start_Key or key in seen or not flows:
+            break
+        seen.add(key)
+        path = 'Snh_NextFlowRecordsSet?flow_key=' + key
+
+def flowField(fields, *tags):
+    """ text of the first of tags in fields (tag to child element of a
+        flow), lists give their first element. Field names differ between
+        agent releases """
+    for tag in tags:
+        e = fields.get(tag)
+        if e is None:
+            continue
+        if e.get('type') == 'list':
+            return e.findtext('list/element')
+        return e.text
+    return None
+
+def flowSummary(nodes, top, by, format):
+    """ vr flow: running aggregates over the flow table of agents, which
+        is read as a stream. Groups with few distinct keys (VRF, VN pair,
+        action, drop reason) are counted exactly, the largest flows are
+        kept in a heap of top entries and talkers (source addresses) in a
+        space-saving counter of 20 x top keys """
+    groups = OrderedDict((name, {}) for name in
+                         ('vrf', 'vn', 'action', 'drop_reason'))
+    talkers = SpaceSaving(max(20 * top, 100))
+    flows = []
+    total = [0, 0, 0]
+    sequence = 0
+    for ist in nodes:
+        try:
+            for flow in flowRecords(ist):
+                flow = dict((e.tag, e) for e in flow)
+                nbytes = int(flowField(flow, 'stats_bytes', 'bytes') or 0)
+                npackets = int(flowField(flow, 'stats_packets',
+                                         'packets') or 0)
+                weight = {'bytes': nbytes, 'packets': npackets,
+                          'flows': 1}[by]
+                sip = flowField(flow, 'sip')
+                actions = flow.get('action_str')
+                action = actions is not None and '|'.join(
+                    e.text for e in actions.iter('action') if e.text) or \
+                    flowField(flow, 'action')
+                drop = flowField(flow, 'drop_reason')
+                keys = (('vrf', flowField(flow, 'vrf')),
+                        ('vn', (flowField(flow, 'src_vn_list', 'source_vn',
+                                          'src_vn'),
+                                flowField(flow, 'dst_vn_list', 'dest_vn',
+                                          'dst_vn'))),
+                        ('action', action),
+                        ('drop_reason', drop if drop not in
+                         (None, '', 'UNKNOWN', 'NONE') else None))
+                for name, key in keys:
+                    if key is None:
+                        continue
+                    counter = groups[name].get(key)
+                    if counter is None:
+                        counter = groups[name][key] = [0, 0, 0]
+                    counter[0] += 1
+                    counter[1] += nbytes
+                    counter[2] += npackets
+                total[0] += 1
+                total[1] += nbytes
+                total[2] += npackets
+                talkers.add(sip, weight)
+                sequence += 1
+                rank = nbytes if by == 'flows' else weight
+                if len(flows) < top or (flows and rank > flows[0][0]):
+                    entry = (rank, sequence, ist.host, keys[0][1], sip,
+                             flowField(flow, 'src_port'),
+                             flowField(flow, 'dip'),
+                             flowField(flow, 'dst_port', 'dest_port'),
+                             flowField(flow, 'protocol'), action, nbytes,
+                             npackets)
+                    if len(flows) < top:
+                        heapq.heappush(flows, entry)
+                    else:
+                        heapq.heapreplace(flows, entry)
+        except IntrospectError as e:
+            reportError(ist.host, e)
+
+    column = {'flows': 0, 'bytes': 1, 'packets': 2}[by]
+    sections = [('talkers', ['source', by, 'error'],
+                 [[k, w, e] for k, w, e in talkers.top(top)]),
+                ('flows', ['node', 'vrf', 'sip', 'sport', 'dip', 'dport',
+                           'proto', 'action', 'bytes', 'packets'],
+                 [list(f[2:]) for f in sorted(flows, reverse=True)])]
+    for name, counters in groups.iteritems():
+        rows = heapq.nlargest(top, counters.iteritems(),
+                              key=lambda item: item[1][column])
+        if name == 'vn':
+            sections.append((name, ['src_vn', 'dst_vn', 'flows', 'bytes',
+                                    'packets'],
+                             [list(k) + c for k, c in rows]))
+        else:
+            sections.append((name, [name, 'flows', 'bytes', 'packets'],
+                             [[k] + c for k, c in rows]))
+
+    if format == 'jsonl':
+        out = RecordWriter(format, None)
+        out.write(OrderedDict([('group', 'total'), ('flows', total[0]),
+                               ('bytes', total[1]), ('packets', total[2])]))
+        for name, fields, rows in sections:
+            for row in rows:
+                out.write(OrderedDict([('group', name)] + zip(fields, row)))
+        return
+
+    print "%d flows, %d bytes, %d packets" % tuple(total)
+    titles = {'talkers': 'Top talkers by %s' % by,
+              'flows': 'Top flows by %s' % ('bytes' if by == 'flows'
+                                            else by), 'vrf': 'VRFs',
+              'vn': 'VN pairs', 'action': 'Actions',
+              'drop_reason': 'Drop reasons'}
+    for name, fields, rows in sections:
+        if not rows:
+            continue
+        print "\n%s:" % titles[name]
+        tbl = prettytable.PrettyTable(fields)
+        tbl.align = 'l'
+        for row in rows:
+            tbl.add_row(['-' if v is None else v for v in row])
+        print tbl
+
+Health_States = {
+    'Functional': 'up',
+    'Non-Functional': 'DOWN',
+    'Initializing': 'init',
+}
+
+def healthServices():
+    """ (column, service, port) of every distinct introspect port """
+    roles = dict((service, role) for role, service in ServiceMap.items())
+    services = {}
+    for service, port in CLI_basic.IntrospectPortMap.items():
+        service = service.split(':')[0]
+        if port not in services or service in roles:
+            services[port] = service
+    return sorted((roles.get(service, service.replace('contrail-', '')),
+                   service, port) for port, service in services.items())
+
+def nodeHealth(ist):
+    """ state, connections up, connections and problems of a
+        NodeStatus response. The worst process state wins """
+    states = [state.text for state in
+              compiledXPath('//ProcessStatus/state')(ist.output_etree[0])]
+    problems = [text for text in compiledXPath(
+                    '//ProcessStatus/description/text()')(
+                        ist.output_etree[0]) if text.strip()]
+    up = 0
+    connections = compiledXPath('//ConnectionInfo')(ist.output_etree[0])
+    for conn in connections:
+        if conn.findtext('status') == 'Up':
+            up += 1
+        else:
+            problems.append('%s %s %s' % (conn.findtext('type'),
+                                          conn.findtext('name'),
+                                          conn.findtext('status')))
+    if not states:
+        state = 'unknown'
+    elif all(state == 'Functional' for state in states):
+        state = 'Functional'
+    else:
+        state = next(state for state in states if state != 'Functional')
+    return state, up, len(connections), problems
+
+def healthSweep(hosts, limit, timeout, format, detail):
+    """ ist health: NodeStatus of every introspect port of every host,
+        all requests in flight at once on the event loop, as one matrix
+        of hosts by services """
+    path = 'Snh_SandeshUVECacheReq?tname=NodeStatus'
+    services = healthServices()
+    jobs = [(Introspect(host, port, None), path)
+            for host in hosts for _, _, port in services]
+    results = {}
+    for chain in AsyncEngine(limit, timeout).run(jobs):
+        ist = chain.ist
+        if chain.error is None:
+            try:
+                ist.usePages(path, chain.pages)
+                results[ist.host, ist.port] = nodeHealth(ist)
+            except (etree.XMLSyntaxError, IndexError) as e:
+                results[ist.host, ist.port] = ('invalid', 0, 0, [str(e)])
+        elif 'refused' not in chain.error.detail:
+            reason = 'timeout' if 'timed out' in chain.error.detail \
+                     else 'error'
+            results[ist.host, ist.port] = (reason, 0, 0,
+                                           [chain.error.detail])
+
+    # services no host answers on are left out
+    columns = [(column, service, port) for column, service, port in services
+               if any((host, port) in results for host in hosts)]
+
+    if format in RecordWriter.formats:
+        out = RecordWriter(format, ['host', 'service', 'port', 'state',
+                                    'connections_up', 'connections',
+                                    'problems'])
+        for host in hosts:
+            for column, service, port in columns:
+                if (host, port) in results:
+                    state, up, total, problems = results[host, port]
+                    out.write(OrderedDict([
+                        ('host', host), ('service', service), ('port', port),
+                        ('state', state), ('connections_up', up),
+                        ('connections', total), ('problems', problems)]))
+        return
+
+    tbl = prettytable.PrettyTable(['host'] + [c for c, _, _ in columns])
+    tbl.align = 'l'
+    for host in hosts:
+        row = [host]
+        for column, service, port in columns:
+            if (host, port) not in results:
+                row.append('-')
+                continue
+            state, up, total, problems = results[host, port]
+            cell = Health_States.get(state, state)
+            if total:
+                cell += ' %d/%d' % (up, total)
+            row.append(cell)
+        tbl.add_row(row)
+    print tbl
+    if detail:
+        for host in hosts:
+            for column, service, port in columns:
+                state, _, _, problems = results.get((host, port),
+                                                    (None, 0, 0, []))
+                for problem in problems:
+                    print "%s %s: %s" % (host, column, problem)
+
+def querySnapshot(filename, query, format):
+    """ ist snapshot: tables of a database written with --snapshot, or the
+        result of an SQL query over it """
+    if not os.path.exists(filename):
+        print "No such snapshot: %s" % filename
+        sys.exit(1)
+    db = sqlite3.connect(filename)
+    try:
+        if query:
+            cursor = db.execute(query)
+            fields = [d[0] for d in cursor.description or []]
+            rows = cursor
+        else:
+            fields = ['table', 'rows', 'columns']
+            rows = []
+            for (table,) in db.execute("SELECT name FROM sqlite_master "
+                                       "WHERE type = 'table' ORDER BY name"):
+                quoted = RecordStore.quote(table)
+                rows.append((table,
+                             db.execute('SELECT COUNT(*) FROM %s'
+                                        % quoted).fetchone()[0],
+                             len(db.execute('PRAGMA table_info(%s)'
+                                            % quoted).fetchall())))
+        if format in RecordWriter.formats:
+            out = RecordWriter(format, fields)
+            for row in rows:
+                out.write(OrderedDict(zip(fields, row)))
+        elif fields:
+            tbl = prettytable.PrettyTable(fields)
+            tbl.align = 'l'
+            for row in rows:
+                tbl.add_row(['' if v is None else v for v in row])
+            print tbl
+    except sqlite3.Error as e:
+        print "SQL error: %s" % e
+        sys.exit(1)
+    finally:
+        db.close()
+
+def followTrace(ist, xpathExpr, interval, since, until):
+    """ re-poll the trace buffer of the last request of ist every interval
+        seconds and print only entries newer than the newest one printed.
+        Entries sharing that timestamp are told apart by their text """
+    path = ist.path
+    last = None
+    seen = set()
+    first = True
+    try:
+        while True:
+            start = time.time()
+            if not first:
+                ist.get(path)
+            newest, newest_seen = last, set(seen)
+            out = TextSink()
+            printed = False
+            for usec, text in ist.traceEntries(xpathExpr, since, until):
+                if usec is None:
+                    if not first:
+                        continue
+                elif last is not None and (usec < last or
+                                           usec == last and text in seen):
+                    continue
+                else:
+                    if newest is None or usec > newest:
+                        newest, newest_seen = usec, set()
+                    if usec == newest:
+                        newest_seen.add(text)
+                out.write('\n' + Introspect.traceToStr(usec, text) + '\n')
+                printed = True
+            if printed:
+                out.close()
+            sys.stdout.flush()
+            last, seen = newest, newest_seen
+            first = False
+            if until is not None and time.time() * 1000000 > until:
+                break
+            time.sleep(max(0, interval - (time.time() - start)))
+    except KeyboardInterrupt:
+        pass
+
+XPath_Cache = {}
+
+def compiledXPath(xpathExpr):
+    """ compile xpathExpr once per run, the same selectors are applied
+        to every page and often to every record """
+    try:
+        return XPath_Cache[xpathExpr]
+    except KeyError:
+        return XPath_Cache.setdefault(xpathExpr, etree.XPath(xpathExpr))
+
+def streamSpec(xpathExpr):
+    """ map an xpath of the form '//Tag[predicate] | //Tag2 ...' to
+        {tag: compiled predicate or None} for iterparse based streaming.
+        Returns None for expressions that need the whole document """
+    spec = {}
+    for part in xpathExpr.split('|'):
+        m = re.match(r'^\s*//([A-Za-z_][\w.-]*)(\[.*\])?\s*$', part)
+        if not m:
+            return None
+        tag, predicate = m.groups()
+        if predicate:
+            spec[tag] = compiledXPath('self::' + tag + predicate)
+        else:
+            spec[tag] = None
+    return spec
+
+def nextPage(path, body, follow_all):
+    """ find the link to the page following raw page body of path without
+        parsing the whole document.
+        Returns (next path or None, whether body itself is to be kept).
+        With follow_all a paginated response is replaced by its 'all' page,
+        otherwise next_page links are walked one by one """
+    if follow_all and 'Snh_PageReq?x=' in path:
+        return None, True
+
+    start = body.rfind('<PageReqData')
+    if start >= 0:
+        m = re.search(r'<next_page[^>]*>([^<]+)</next_page>', body[start:])
+        if not m:
+            return None, True
+        if not follow_all:
+            return 'Snh_PageReq?x=' + saxutils.unescape(m.group(1)), True
+        m = re.search(r'<all[^>]*>([^<]+)</all>', body[start:])
+        if not m:
+            sys.stderr.write("Warning: all page in pagination is empty!\n")
+            return None, True
+        return 'Snh_PageReq?x=' + saxutils.unescape(m.group(1)), False
+
+    start = body.rfind('<next_batch')
+    if start >= 0:
+        m = re.match(r'<next_batch[^>]*link="([^"]*)"[^>]*>([^<]+)</next_batch>',
+                     body[start:])
+        if m and m.group(1):
+            return ('Snh_' + saxutils.unescape(m.group(1)) + '?x=' +
+                    saxutils.unescape(m.group(2))), True
+    return None, True
+
 def is_ipv4(addr):
     try:
         socket.inet_pton(socket.AF_INET, addr)
@@ -1884,32 +4731,9 @@ def is_ipv6(addr):
         return False
     return True
 
-def addressInNetwork(addr, prefix):
-    ipaddr = struct.unpack('!L',socket.inet_aton(addr))[0]
-    pure_prefix = prefix.split(':')[-1]  # strip RD info if any
-    netaddr,bits = pure_prefix.split('/')
-    netaddr = struct.unpack('!L',socket.inet_aton(netaddr))[0]
-    netmask = ((1<<(32-int(bits))) - 1)^0xffffffff
-    return ipaddr & netmask == netaddr & netmask
-
-def addressInNetwork6(addr, prefix):
-    addr_upper,addr_lower = struct.unpack(
-                            '!QQ',socket.inet_pton(socket.AF_INET6, addr))
-    netaddr,bits = prefix.split('/')
-    net_upper,net_lower = struct.unpack(
-                          '!QQ',socket.inet_pton(socket.AF_INET6, netaddr))
-    if int(bits) < 65 :
-        netmask = ((1<<(64-int(bits))) - 1)^0xffffffffffffffff
-        return addr_upper & netmask == net_upper & netmask
-    elif addr_upper != net_upper:
-        return False
-    else:
-        netmask = ((1<<(128-int(bits))) - 1)^0xffffffffffffffff
-        return addr_lower & netmask == net_lower & netmask
-
 def validate_uuid(id):
     try:
-        obj = UUID(str(id))
+        obj = uuid.UUID(str(id))
     except:
         return False
     return str(id)
@@ -1922,36 +4746,82 @@ def main():
         print version
         sys.exit()
 
-    host = os.environ.get('INTROSPECT_HOST', None)
-    port = os.environ.get('INTROSPECT_PORT', None)
-    filename = None
-
-    try:
-        host = argv[argv.index('--host') + 1]
-    except ValueError:
-        pass
-
-    try:
-        port = argv[argv.index('--port') + 1]
-    except ValueError:
-        pass
+    global timings
+    timings_json = optionValue(argv, '--timings-json')
+    if timings_json:
+        timings = Timings(timings_json)
+    elif '--timings' in argv:
+        timings = Timings()
 
-    try:
-        filename = argv[argv.index('--file') + 1]
-    except ValueError:
-        pass
+    host = optionValue(argv, '--host') or \
+        os.environ.get('INTROSPECT_HOST', None)
+    port = optionValue(argv, '--port') or \
+        os.environ.get('INTROSPECT_PORT', None)
+    filename = optionValue(argv, '--file')
 
     if filename and not os.path.isfile(filename):
         print "Failed to find " + filename
         sys.exit(1)
 
+    if filename and tarfile.is_tarfile(filename):
+        sys.stderr.write("Replaying introspect archive %s\n" % filename)
+
+    hosts = []
     if host:
-        print "Introspect Host: " + host
+        hosts = [h.strip() for h in host.split(',') if h.strip()]
+
+    hosts_file = optionValue(argv, '--hosts-file')
+    if hosts_file:
+        try:
+            with open(hosts_file) as f:
+                for line in f:
+                    line = line.split('#')[0].strip()
+                    if line:
+                        hosts.append(line)
+        except IOError as e:
+            print "Failed to read %s: %s" % (hosts_file, e.strerror)
+            sys.exit(1)
+
+    global workers
+    workers_option = optionValue(argv, '--workers', positive_int)
+    if workers_option:
+        workers = workers_option
+
+    global limit
+    limit = optionValue(argv, '--limit', positive_int)
+
+    global cache
+    if '--cache' in argv:
+        cache_dir = os.environ.get('IST_CACHE_DIR', Default_Cache_Dir)
+        cache_ttl = optionValue(argv, '--cache-ttl', positive_int) or \
+            Default_Cache_TTL
+        cache_size = optionValue(argv, '--cache-size', positive_int) or \
+            Default_Cache_Size
+        cache = ResponseCache(cache_dir, cache_ttl, cache_size << 20)
+
+    if len(hosts) > 1:
+        host = hosts
+    elif hosts:
+        host = hosts[0]
+        # status, not output: kept out of jsonl/csv/tsv
+        sys.stderr.write("Introspect Host: %s\n" % host)
 
     global debug
     if '--debug' in argv:
         debug = True
 
+    global stream
+    if '--stream' in argv:
+        stream = True
+
+    global pipeline
+    if '--pipeline' in argv:
+        pipeline = True
+
+    global asynchronous
+    if '--async' in argv:
+        asynchronous = True
+
     parser = argparse.ArgumentParser(prog='ist',
                                      description='A script to make Contrail '
                                                  'Introspect output CLI '
@@ -1960,19 +4830,164 @@ def main():
                         help="Script version")
     parser.add_argument('--debug', action="store_true",
                         help="Verbose mode")
+    parser.add_argument('--stream', action="store_true",
+                        help="Parse and print records while pages are "
+                             "downloaded, with flat memory usage. Table "
+                             "columns are sized from the first %d rows"
+                             % Table_Sample)
+    parser.add_argument('--pipeline', action="store_true",
+                        help="Fetch next pages in background while the "
+                             "current one is parsed")
+    parser.add_argument('--async', action="store_true",
+                        help="Send independent requests, and requests to "
+                             "many hosts, concurrently from one event loop "
+                             "with up to --workers in flight")
+    parser.add_argument('--cache', action="store_true",
+                        help="Serve repeated requests from a local response "
+                             "cache ($IST_CACHE_DIR, default: %s)"
+                             % Default_Cache_Dir)
+    parser.add_argument('--cache-ttl', type=positive_int,
+                        help="Seconds a cached response stays valid. "
+                             "Default: %d" % Default_Cache_TTL)
+    parser.add_argument('--cache-size', type=positive_int,
+                        help="Max cache size in MB. Default: %d"
+                             % Default_Cache_Size)
+    parser.add_argument('--timings', action="store_true",
+                        help="Print where the time went to stderr: fetch "
+                             "(ttfb, latency), parse and render times, and "
+                             "peak RSS")
+    parser.add_argument('--timings-json', type=str, metavar='FILE',
+                        help="Same as --timings, and also write per-page "
+                             "timings to FILE as JSON")
+    parser.add_argument('--capture', type=str, metavar='ARCHIVE',
+                        help="Record every page fetched into a compressed "
+                             "archive, which can be replayed with --file")
+    parser.add_argument('--snapshot', type=str, metavar='DBFILE',
+                        help="Also store the records of the command in the "
+                             "SQLite database DBFILE, one table per Sandesh "
+                             "type, see 'snapshot' to query it")
+    parser.add_argument('--file', type=str,
+                        help="Introspect xml file or archive created with "
+                             "--capture to read instead of a live host")
     parser.add_argument('--host', type=str,
-                        help="Introspect host address. Default: localhost")
+                        help="Introspect host address, or comma separated "
+                             "list of hosts. Default: localhost")
+    parser.add_argument('--hosts-file', type=str,
+                        help="File listing introspect hosts, one per line")
+    parser.add_argument('--workers', type=positive_int,
+                        help="Max hosts (with --async requests) queried in "
+                             "parallel. Default: %d"
+                             % Default_Workers)
     parser.add_argument('--port', type=int, help="Introspect port number")
+    parser.add_argument('--limit', type=positive_int, metavar='N',
+                        help="Print at most N records per host, and stop "
+                             "fetching pages once they are read")
 
     roleparsers = parser.add_subparsers()
 
+    # only the role given on the command line builds its command tree,
+    # it is the first argument which isn't an option or an option value
+    role = None
+    value_options = [o for a in parser._actions if a.nargs != 0
+                     for o in a.option_strings]
+    options = iter(argv)
+    for arg in options:
+        if arg in value_options:
+            next(options, None)
+        elif not arg.startswith('-'):
+            role = arg
+            break
+
     for svc in sorted(ServiceMap.iterkeys()):
         p = roleparsers.add_parser(svc, help=ServiceMap[svc])
-        if 'CLI_%s' % (svc) in globals():
+        if svc == role and 'CLI_%s' % (svc) in globals():
             globals()['CLI_%s' % (svc)](p, host, port, filename)
 
+    p = roleparsers.add_parser('mtrace', help='Trace buffers of many hosts '
+                                              'and roles on one timeline')
+    p.add_argument('source', nargs='+',
+                   help='ROLE[@HOST[:PORT][,HOST...]][/BUFFER], e.g. '
+                        'ctr@ctl1,ctl2/XmppMessageTrace. Without @HOST, '
+                        '--host hosts are used')
+    p.add_argument('-b', '--buffer',
+                   help='Trace buffer of sources without /BUFFER')
+    p.add_argument('--since', type=valid_time,
+                   help='Only entries from this time on, see trace --since')
+    p.add_argument('--until', type=valid_time,
+                   help='Only entries up to this time')
+    p.set_defaults(func=lambda args: mergedTrace(
+        args, hosts or ['127.0.0.1'], port and int(port), filename))
+
+    p = roleparsers.add_parser('snapshot', help='Query a database written '
+                                                'with --snapshot')
+    p.add_argument('database', help='SQLite file given to --snapshot')
+    p.add_argument('query', nargs='?',
+                   help='SQL query. Without one, tables and row counts '
+                        'are listed')
+    p.add_argument('-f', '--format', choices=['table', 'jsonl', 'csv', 'tsv'],
+                   default='table', help='Output format.')
+    p.set_defaults(func=lambda args: querySnapshot(args.database, args.query,
+                                                   args.format))
+
+    p = roleparsers.add_parser('health', help='NodeStatus of every '
+                                              'introspect port of the hosts')
+    p.add_argument('-f', '--format', choices=['table', 'jsonl', 'csv', 'tsv'],
+                   default='table', help='Output format.')
+    p.add_argument('--timeout', type=float, default=Health_Timeout,
+                   help='Seconds to wait for each service. Default: %d'
+                        % Health_Timeout)
+    p.add_argument('-d', '--detail', action="store_true",
+                   help='List down connections and process problems '
+                        'below the matrix')
+    p.set_defaults(func=lambda args: healthSweep(
+        hosts or ['127.0.0.1'],
+        workers_option or Health_Workers,
+        args.timeout, args.format, args.detail))
+
     args, unknown = parser.parse_known_args()
-    args.func(args)
+
+    global capture
+    try:
+        archive = optionValue(argv, '--capture')
+        if archive:
+            capture = SnapshotArchive.create(archive)
+    except (IOError, OSError) as e:
+        print "Failed to create archive: %s" % e
+        sys.exit(1)
+
+    global snapshot
+    try:
+        database = optionValue(argv, '--snapshot')
+        if database:
+            snapshot = RecordStore(database)
+    except sqlite3.Error as e:
+        print "Failed to open snapshot: %s" % e
+        sys.exit(1)
+
+    try:
+        args.func(args)
+        # buffered output too, so a closed pipe is handled below rather
+        # than at interpreter exit
+        sys.stdout.flush()
+        if failures:
+            sys.exit(1)
+    except IntrospectError as e:
+        print e
+        sys.exit(1)
+    except IOError as e:
+        if e.errno != errno.EPIPE or isinstance(e, socket.error):
+            raise
+        # reader went away (e.g. head), stop quietly and point stdout
+        # to /dev/null so nothing is flushed to the closed pipe at exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(128 + signal.SIGPIPE)
+    finally:
+        if capture:
+            capture.close()
+        if snapshot:
+            snapshot.close()
+        if timings:
+            timings.report()
 
 if __name__ == "__main__":
     main()